@@ -0,0 +1,244 @@
+import time
+import json
+import platform
+import datetime
+import subprocess
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from scipy.interpolate import interp1d
+
+from res_ind_lib import *
+from policy_assessment import compute_policies, compute_policies_mh
+from parallel import parallel_compute_resiliences
+from resilience_model import ResilienceModel
+from uncertainty import monte_carlo
+
+def densify_faratios(fa_ratios, n):
+    """fa_ratios on n return periods, log-spaced between its first and last return periods (linear interpolation in rp, as in interpolate_faratios)"""
+    rps = fa_ratios.columns.values.astype(float)
+    new_rps = np.unique(np.round(np.geomspace(rps.min(), rps.max(), n), 6))
+    new_rps[[0, -1]] = rps.min(), rps.max()
+
+    dense = pd.DataFrame(interp1d(rps, fa_ratios.values)(new_rps), index=fa_ratios.index, columns=new_rps)
+    dense.columns.name = "rp"
+    return dense
+
+def integration_convergence(df, fa_ratios, multihazard_data=None, rp_counts=[2, 3, 5, 9, 17, 33, 65], reference_count=2049, outputs=["dWtot_currency", "dKtot"]):
+    """Convergence of the integration modes of compute_resiliences when return periods are added to fa_ratios (see densify_faratios).
+    Errors are relative to the "bins" result on reference_count return periods, summed over provinces.
+    Returns a dataframe indexed by (integration, number of return periods) with the error on each output and the computation time"""
+
+    reference = compute_resiliences(df, densify_faratios(fa_ratios, reference_count), multihazard_data, engine="numpy")[outputs].sum()
+
+    results = dict()
+    for integration in ["bins", "trapezoidal", "loglinear"]:
+        for n in rp_counts:
+            dense = densify_faratios(fa_ratios, n)
+
+            t = time.time()
+            out = compute_resiliences(df, dense, multihazard_data, engine="numpy", integration=integration)
+            duration = time.time()-t
+
+            line = ((out[outputs].sum()-reference)/reference).abs()
+            line["seconds"] = duration
+            results[(integration, dense.shape[1])] = line
+
+    results = pd.DataFrame(results).T
+    results.index.names = ["integration", "rps"]
+    return results
+
+def parallel_scaling(df, fa_ratios=None, multihazard_data=None, workers=[1, 2, 4, 8], scenarios=64, **kwargs):
+    """Time of parallel_compute_resiliences on scenarios stacked copies of df, for each number of workers.
+    kwargs: passed to compute_resiliences (engine, integration).
+    Returns a dataframe indexed by number of workers, with the time in seconds and the speedup relative to the first number of workers"""
+
+    stacked = pd.concat([df]*scenarios, keys=range(scenarios), names=["scenario"])
+
+    seconds = pd.Series(index=pd.Index(workers, name="workers"), dtype=float)
+    for w in workers:
+        t = time.time()
+        parallel_compute_resiliences(stacked, fa_ratios, multihazard_data, workers=w, **kwargs)
+        seconds[w] = time.time()-t
+
+    return pd.DataFrame(dict(seconds=seconds, speedup=seconds.iloc[0]/seconds))
+
+def peak_memory(f, *args, **kwargs):
+    """Peak memory allocated (in bytes, as traced by tracemalloc) while running f(*args, **kwargs)"""
+    tracemalloc.start()
+    try:
+        f(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def memory_check(df, fa_ratios=None, multihazard_data=None, max_multiple=2):
+    """Checks that a repeated evaluation of a ResilienceModel, once its plan and buffers exist, allocates less than max_multiple times the size of df.
+    Returns a series with the peak memory of compute_resiliences, of the first and of the next evaluations, relative to the size of df"""
+
+    size = df.memory_usage(deep=True).sum()
+    model = ResilienceModel(fa_ratios, multihazard_data)
+
+    peaks = pd.Series(dict(
+        compute_resiliences=peak_memory(compute_resiliences, df, fa_ratios, multihazard_data),
+        first_evaluation=peak_memory(model.evaluate_arrays, df),
+        next_evaluation=peak_memory(model.evaluate_arrays, df)))/size
+
+    assert peaks["next_evaluation"]<max_multiple, "repeated evaluations allocate {:.1f} times the size of the inputs".format(peaks["next_evaluation"])
+
+    return peaks
+
+def precision_report(df, fa_ratios=None, multihazard_data=None, dtype=np.float32):
+    """Relative error of a ResilienceModel computed in dtype (float32 by default) against float64, on each output.
+    Returns a dataframe indexed by output, with the maximum and median relative errors over provinces"""
+
+    exact = ResilienceModel(fa_ratios, multihazard_data).evaluate(df)
+    approx = ResilienceModel(fa_ratios, multihazard_data, dtype=dtype).evaluate(df)
+
+    outputs = [c for c in exact.columns if c not in df.columns]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        error = ((approx[outputs]-exact[outputs])/exact[outputs]).abs().replace(np.inf, np.nan)
+
+    return pd.DataFrame(dict(max=error.max(), median=error.median()))
+
+def synthetic_inputs(df, multihazard_data, units, hazards=2, rps=2, seed=0):
+    """Inputs with the schema of df (all_data_compiled.xlsx, with def_ref_values), multihazard_data (multi_hazard_data.csv) and fa_ratios.csv, 
+    for units provinces ("unit0", "unit1", ...), hazards hazards and rps return periods (log-spaced between 10 and 1000 years).
+    The lines of each unit are drawn at random among the lines of df and multihazard_data.
+    Returns (df, multihazard_data, fa_ratios)"""
+
+    rng = np.random.RandomState(seed)
+    names = pd.Index(["unit{}".format(i) for i in range(units)], name=df.index.name)
+    hazard_names = ["hazard{}".format(h) for h in range(hazards)]
+
+    df_syn = df.iloc[rng.randint(len(df), size=units)].copy()
+    df_syn.index = names
+
+    index = pd.MultiIndex.from_product([names, hazard_names], names=["province", "hazard"])
+    mh_syn = multihazard_data.iloc[rng.randint(len(multihazard_data), size=len(index))].copy()
+    mh_syn.index = index
+
+    #exposure ratio 1 at the first return period, increasing with the return period
+    rp_values = np.unique(np.round(np.geomspace(10, 1000, rps)))
+    growth = rng.uniform(0, 3, size=(len(index), 1))
+    fa_syn = pd.DataFrame(1+growth*np.linspace(0, 1, len(rp_values)), index=index, columns=pd.Index(rp_values, name="rp"))
+
+    return df_syn, mh_syn, fa_syn
+
+def stage_times(df, fa_ratios=None, multihazard_data=None, integration="bins"):
+    """Time (in seconds) of each stage of compute_resiliences (pandas engine).
+    Returns a series indexed by stage"""
+
+    times = pd.Series(dtype=float)
+
+    def timed(stage, f, *args):
+        t = time.perf_counter()
+        out = f(*args)
+        times[stage] = time.perf_counter()-t
+        return out
+
+    dfh = timed("broadcast_hazard", broadcast_hazard, multihazard_data, df)
+    fa_ratios_interp = timed("interpolate_faratios", interpolate_faratios, fa_ratios, df.protection.unique().tolist())
+    dfhr = timed("broadcast_return_periods", broadcast_return_periods, fa_ratios_interp, dfh)
+    dkdwhr = timed("compute_dK_dW", compute_dK_dW, dfhr)
+    dkdwh = timed("average_over_rp", average_over_rp, dkdwhr, dfhr["protectionref"], integration)
+    dkdw = timed("sum_over_hazard", sum_over_hazard, dkdwh)
+
+    df = df.copy()
+    df[dkdw.columns] = dkdw
+    timed("calc_risk_and_resilience_from_k_w", calc_risk_and_resilience_from_k_w, df)
+
+    return times
+
+def run_benchmarks(df, multihazard_data, units=[80, 1000, 10000, 100000], hazards=[1, 2, 5], rps=[2, 10, 50], 
+                   max_events=2*10**6, policy_units=1000, pol_increment=None, distributions=None, samples=100, repeat=3, output_path=None):
+    """Times compute_resiliences (both engines), each of its stages (see stage_times), compute_policies, compute_policies_mh and monte_carlo
+    on synthetic inputs (see synthetic_inputs) for each combination of units, hazards and rps.
+    df, multihazard_data: templates of the synthetic inputs (all_data_compiled.xlsx with def_ref_values, and multi_hazard_data.csv).
+    max_events: cases with more events (units x hazards x return periods) are skipped.
+    policy_units: policies are only timed up to that many units (each policy is a full evaluation).
+    pol_increment: policies of compute_policies (defaults to inputs/policy_description.csv). Those of compute_policies_mh increment fap and far by 0.01 for each hazard.
+    distributions, samples: monte_carlo draws samples samples of distributions (defaults to inputs/uncertainty_description.csv, which samples income_elast so that each sample has its own elasticity),
+        and again without income_elast ("monte_carlo_fixed_elast"). Timed up to policy_units units.
+    repeat: each time is the best of repeat runs.
+    output_path: if provided, results are saved there as json (see save_benchmarks), to compare versions with compare_benchmarks.
+    Returns a dataframe indexed by (units, hazards, rps, benchmark), with the time in seconds"""
+
+    if pol_increment is None:
+        pol_increment = pd.read_csv("inputs/policy_description.csv", index_col=0).increment
+    if distributions is None:
+        distributions = pd.read_csv("inputs/uncertainty_description.csv", index_col=0)
+    outputs = ["dWtot_currency", "dKtot"]
+
+    def best(f, *args, **kwargs):
+        times = []
+        for _ in range(repeat):
+            t = time.perf_counter()
+            f(*args, **kwargs)
+            times.append(time.perf_counter()-t)
+        return min(times)
+
+    results = dict()
+    for n in units:
+        for h in hazards:
+            for r in rps:
+                if n*h*r>max_events:
+                    continue
+                df_syn, mh_syn, fa_syn = synthetic_inputs(df, multihazard_data, n, h, r)
+                case = (n, h, r)
+
+                results[case+("compute_resiliences",)] = best(compute_resiliences, df_syn, fa_syn, mh_syn)
+                results[case+("compute_resiliences_numpy",)] = best(compute_resiliences, df_syn, fa_syn, mh_syn, engine="numpy")
+
+                stages = pd.concat([stage_times(df_syn, fa_syn, mh_syn) for _ in range(repeat)], axis=1).min(axis=1)
+                for stage, seconds in stages.items():
+                    results[case+(stage,)] = seconds
+
+                if n<=policy_units:
+                    pol_increment_mh = pd.Series(0.01, index=[str((c, haz)) for c in mh_syn.columns for haz in mh_syn.index.levels[1]])
+                    results[case+("compute_policies",)] = best(compute_policies, df_syn, pol_increment, outputs, None, fa_ratios=fa_syn, multihazard_data=mh_syn)
+                    results[case+("compute_policies_mh",)] = best(compute_policies_mh, df_syn, mh_syn, pol_increment_mh, outputs, None)
+                    results[case+("monte_carlo",)] = best(monte_carlo, df_syn, distributions, samples, fa_ratios=fa_syn, multihazard_data=mh_syn, seed=0)
+                    results[case+("monte_carlo_fixed_elast",)] = best(monte_carlo, df_syn, distributions.drop("income_elast", errors="ignore"), samples, 
+                                                                     fa_ratios=fa_syn, multihazard_data=mh_syn, seed=0)
+
+    results = pd.Series(results, name="seconds")
+    results.index.names = ["units", "hazards", "rps", "benchmark"]
+
+    if output_path is not None:
+        save_benchmarks(results, output_path)
+
+    return results
+
+def save_benchmarks(results, path, label=None):
+    """Saves results of run_benchmarks as json, with the versions of python, numpy and pandas and the git commit (if any).
+    label: name of the run (defaults to the git commit)"""
+
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    run = dict(label=label if label is not None else commit, commit=commit, date=datetime.datetime.now().isoformat(),
+               python=platform.python_version(), numpy=np.__version__, pandas=pd.__version__, machine=platform.platform(),
+               results=[dict(zip(results.index.names, i), seconds=s) for i, s in results.items()])
+
+    with open(path, "w") as f:
+        json.dump(run, f, indent=1, default=int)
+
+def load_benchmarks(path):
+    """Results saved by save_benchmarks, as a series (see run_benchmarks)"""
+    with open(path) as f:
+        run = json.load(f)
+    return pd.DataFrame(run["results"]).set_index(["units", "hazards", "rps", "benchmark"])["seconds"]
+
+def compare_benchmarks(before, after):
+    """Times of two runs of run_benchmarks (series or json files saved by save_benchmarks) side by side, with the ratio after/before (above 1 is slower)"""
+    if isinstance(before, str):
+        before = load_benchmarks(before)
+    if isinstance(after, str):
+        after = load_benchmarks(after)
+    out = pd.DataFrame(dict(before=before, after=after))
+    out["ratio"] = out.after/out.before
+    return out
@@ -0,0 +1,153 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+def load_inputs(folder="inputs", cache_dir=None):
+    """Reads the input files of the model (as the notebooks do), from a columnar cache after the first time (see cached_read).
+    Returns a dict of dataframes: all_data (all_data_compiled.xlsx), multihazard_data, fa_ratios, protection, inputs_info,
+    policy_description, policy_multihazard_description, colors_pol_assess, PSA_compiled, and one entry per sheet of PSA_materials.xlsx."""
+
+    read = lambda reader, name, **kwargs: cached_read(reader, os.path.join(folder, name), cache_dir, **kwargs)
+
+    inputs = dict()
+
+    #The first (0) row is a description of the variables and the 3rd (2) row is empty
+    inputs["all_data"] = read(pd.read_excel, "all_data_compiled.xlsx", index_col=0, skiprows=[0,2])
+    inputs["all_data"].index.name = "province"
+
+    inputs["multihazard_data"] = read(pd.read_csv, "multi_hazard_data.csv", index_col=["province","hazard"])
+
+    fa_ratios = read(pd.read_csv, "fa_ratios.csv", index_col=["province","hazard"])
+    fa_ratios.columns = fa_ratios.columns.astype(float)
+    fa_ratios.columns.name = "rp"
+    inputs["fa_ratios"] = fa_ratios
+
+    inputs["protection"] = read(pd.read_csv, "protection_phl.csv", index_col=0)
+    inputs["inputs_info"] = read(pd.read_csv, "inputs_info.csv", index_col="key")
+    inputs["policy_description"] = read(pd.read_csv, "policy_description.csv", index_col=0)
+    inputs["policy_multihazard_description"] = read(pd.read_csv, "policy_multihazard_description.csv", index_col=0)
+    inputs["colors_pol_assess"] = read(pd.read_csv, "colors_pol_assess.csv", index_col=0)
+
+    #PSA data
+    inputs["PSA_compiled"] = read(pd.read_excel, "PSA_compiled.xlsx", skiprows=1, index_col=0)
+    inputs["PSA_compiled"].index.name = "province"
+
+    for sheet in ["Prop_Roof_Poor", "Prop_Wall_Poor", "Prop_Roof_Non-poor", "Prop_Wall_Non-poor"]:
+        inputs[sheet] = read(pd.read_excel, "PSA_materials.xlsx", sheet_name=sheet, skiprows=[1], index_col=0)
+
+    return inputs
+
+
+def cached_read(reader, path, cache_dir=None, **kwargs):
+    """reader(path, **kwargs) (for example pd.read_excel), parsed once and then served from a cache.
+    The cache holds one .npy file per numeric column (memory-mapped copy-on-write when loaded, see read_columns) and a json schema with the index, the labels and the other columns.
+    It is reused as long as the source file has the same modification time and size, or else the same content (sha1).
+    cache_dir: defaults to a __cache__ folder next to the source file."""
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(path), "__cache__")
+
+    #one cache per file and way of reading it
+    call = repr((reader.__name__, sorted(kwargs.items())))
+    folder = os.path.join(cache_dir, os.path.basename(path)+"-"+hashlib.sha1(call.encode()).hexdigest()[:10])
+    schema_file = os.path.join(folder, "schema.json")
+
+    stat = os.stat(path)
+    schema = _read_json(schema_file)
+
+    if schema is not None:
+        if schema["mtime"]==stat.st_mtime and schema["size"]==stat.st_size:
+            return read_columns(folder, schema)
+
+        #touched but not modified (for example by a checkout)
+        if schema["sha1"]==file_digest(path):
+            schema.update(mtime=stat.st_mtime, size=stat.st_size)
+            _write_json(schema_file, schema)
+            return read_columns(folder, schema)
+
+    df = reader(path, **kwargs)
+    write_columns(df, folder, dict(source=path, call=call, mtime=stat.st_mtime, size=stat.st_size, sha1=file_digest(path)))
+
+    return df
+
+
+def write_columns(df, folder, schema=None):
+    """Saves df in folder: numeric columns as .npy files, everything else in schema.json (written last).
+    Other columns must be strings or objects json can hold (with their dtype, object or str): other dtypes (dates, categories...) raise a TypeError."""
+
+    os.makedirs(folder, exist_ok=True)
+
+    schema = dict() if schema is None else dict(schema)
+    schema["index"] = _labels_to_json(df.index)
+    schema["columns"] = _labels_to_json(df.columns)
+
+    data = []
+    for i in range(df.shape[1]):
+        values = df.iloc[:, i].values
+        if isinstance(values, np.ndarray) and values.dtype.kind in "biuf":
+            np.save(os.path.join(folder, "{}.npy".format(i)), values)
+            data.append(dict(file="{}.npy".format(i)))
+        elif values.dtype==object or isinstance(values.dtype, pd.StringDtype):
+            data.append(dict(values=values.tolist(), dtype=str(values.dtype)))
+        else:
+            raise TypeError("cannot cache column {} of dtype {}".format(df.columns[i], values.dtype))
+    schema["data"] = data
+
+    _write_json(os.path.join(folder, "schema.json"), schema)
+
+
+def read_columns(folder, schema):
+    """Dataframe saved by write_columns.
+    Numeric columns are memory-mapped copy-on-write: pages are read from disk when used, and writes stay in memory.
+    Whether the frame keeps them depends on pandas: recent versions keep one block per column on its map (copy=False),
+    older ones copy all columns into one block here. Either way, operations that consolidate the frame (copy, .values, most transformations) load it in memory."""
+
+    columns = dict()
+    for i, d in enumerate(schema["data"]):
+        if "file" in d:
+            #plain ndarray view on the memory map (np.memmap subclass dropped)
+            columns[i] = np.asarray(np.load(os.path.join(folder, d["file"]), mmap_mode="c"))
+        else:
+            columns[i] = pd.array(d["values"], dtype=d.get("dtype", "object"))
+
+    df = pd.DataFrame(columns, index=_labels_from_json(schema["index"]), copy=False)
+    df.columns = _labels_from_json(schema["columns"])
+    return df
+
+
+def file_digest(path):
+    """sha1 of the content of a file"""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _labels_to_json(index):
+    return dict(names=list(index.names), levels=[index.get_level_values(i).tolist() for i in range(index.nlevels)])
+
+def _labels_from_json(labels):
+    if len(labels["levels"])==1:
+        return pd.Index(labels["levels"][0], name=labels["names"][0])
+    return pd.MultiIndex.from_arrays(labels["levels"], names=labels["names"])
+
+def _read_json(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def _write_json(path, data):
+    #written under a temporary name, so that readers never see it half written (an interrupted write leaves no schema, hence no cache)
+    temp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(temp, "w") as f:
+            json.dump(data, f)
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
@@ -0,0 +1,152 @@
+import json
+import time
+import tracemalloc
+
+import pandas as pd
+
+#profile being recorded (see profile_stages), None when instrumentation is off
+_active = None
+
+class StageProfile:
+    """Records of the stages run inside profile_stages: wall time, rows in and out, and peak memory allocated (if traced).
+    Stages can be nested (for example the stages of compute_resiliences inside each policy of compute_policies): depth is their level of nesting."""
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.records = []
+        self.stack = []
+        self.origin = time.perf_counter()
+
+    def to_frame(self):
+        """Records as a dataframe, one line per stage run, in the order they started.
+        Columns: stage, label (for example the policy), depth, start and seconds (in seconds since the profile started), rows_in, rows_out, peak_bytes
+        (peak memory allocated during the stage above what was allocated when it started, missing if memory is not traced)"""
+        columns = ["stage", "label", "depth", "start", "seconds", "rows_in", "rows_out", "peak_bytes"]
+        records = sorted(self.records, key=lambda r: r.start)
+        return pd.DataFrame([{c: getattr(r, c) for c in columns} for r in records], columns=columns)
+
+    def summary(self):
+        """Total time, number of calls and largest peak memory of each stage"""
+        return self.to_frame().groupby("stage", sort=False).agg(seconds=("seconds", "sum"), calls=("seconds", "size"), peak_bytes=("peak_bytes", "max"))
+
+    def to_json(self, path=None):
+        """Records as json (written to path if provided, returned as a string otherwise)"""
+        text = self.to_frame().to_json(orient="records")
+        if path is None:
+            return text
+        with open(path, "w") as f:
+            f.write(text)
+
+    def to_chrome_trace(self, path):
+        """Writes the records as a Chrome trace-event file (open in chrome://tracing or https://ui.perfetto.dev)"""
+        events = [dict(name=r.stage if r.label is None else "{} ({})".format(r.stage, r.label), ph="X", pid=0, tid=0,
+                       ts=r.start*1e6, dur=r.seconds*1e6, args=dict(rows_in=r.rows_in, rows_out=r.rows_out, peak_bytes=r.peak_bytes))
+                  for r in self.records]
+        with open(path, "w") as f:
+            json.dump(dict(traceEvents=events, displayTimeUnit="ms"), f)
+
+
+class StageRecord:
+    """One run of a stage (see stage)"""
+
+    def __init__(self, profile, name, rows_in=None, label=None):
+        self.profile = profile
+        self.stage = name
+        self.label = label
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.peak_bytes = None
+        self.depth = len(profile.stack)
+
+    def output(self, x):
+        """Records the number of rows of x (a dataframe, series or array) as the output of the stage, and returns x"""
+        self.rows_out = _rows(x)
+        return x
+
+    def __enter__(self):
+        p = self.profile
+        if p.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if p.stack:
+                p.stack[-1]._peak = max(p.stack[-1]._peak, peak)
+            tracemalloc.reset_peak()
+            self._base = self._peak = current
+        p.stack.append(self)
+        self.start = time.perf_counter()-p.origin
+        return self
+
+    def __exit__(self, *exc):
+        p = self.profile
+        self.seconds = time.perf_counter()-p.origin-self.start
+        p.stack.pop()
+        if p.memory:
+            self._peak = max(self._peak, tracemalloc.get_traced_memory()[1])
+            self.peak_bytes = self._peak-self._base
+            if p.stack:
+                p.stack[-1]._peak = max(p.stack[-1]._peak, self._peak)
+        p.records.append(self)
+        return False
+
+
+class _NoStage:
+    """Stands for a StageRecord when instrumentation is off"""
+
+    def output(self, x):
+        return x
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_no_stage = _NoStage()
+
+
+def stage(name, x=None, label=None):
+    """Context manager that records a stage in the active profile (see profile_stages), and does nothing otherwise.
+    x: input of the stage (its number of rows is recorded). label: distinguishes runs of the same stage (for example the policy).
+
+    with stage("compute_dK_dW", dfhr) as s:
+        dkdwhr = s.output(compute_dK_dW(dfhr))"""
+    if _active is None:
+        return _no_stage
+    return StageRecord(_active, name, _rows(x), label)
+
+
+class profile_stages:
+    """Context manager that records the stages of compute_resiliences, ResilienceModel.evaluate, compute_policies and compute_policies_mh run inside it.
+    memory: if True, also traces the peak memory of each stage with tracemalloc (which slows the computation down).
+
+    with profile_stages() as profile:
+        compute_resiliences(df, fa_ratios, multihazard_data)
+    profile.to_frame()
+    profile.to_chrome_trace("trace.json")"""
+
+    def __init__(self, memory=True):
+        self.profile = StageProfile(memory)
+
+    def __enter__(self):
+        global _active
+        self.previous = _active
+        self.started_tracing = self.profile.memory and not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+        _active = self.profile
+        return self.profile
+
+    def __exit__(self, *exc):
+        global _active
+        _active = self.previous
+        if self.started_tracing:
+            tracemalloc.stop()
+        return False
+
+
+def _rows(x):
+    """Number of rows of x, None if x is None"""
+    if x is None:
+        return None
+    if isinstance(x, dict):
+        return len(next(iter(x.values()))) if x else 0
+    return len(x)
@@ -7,143 +7,356 @@ import numpy as np
 #############################################################################     
     
 from bs4 import BeautifulSoup    
-from IPython.display import Image, display, HTML, SVG
+from progress_reporter import get_progress_backend, in_notebook
 img_width = 400
 
-import os, shutil
-from subprocess import Popen, PIPE, call 
+import io, os, re
+from xml.sax.saxutils import escape
+import PIL.Image
+from matplotlib.figure import Figure
+from matplotlib.collections import PathCollection
+from matplotlib.path import Path
 
-def make_map_from_svg(series_in, svg_file_path, outname, color_maper=plt.cm.get_cmap("Blues"), label = "", outfolder ="img/" , new_title=None, verbose=True):
+def make_map_from_svg(series_in, svg_file_path, outname, color_maper=None, label = "", outfolder ="img/" , new_title=None, verbose=True, dpi=150, backend=None, simplify=True):
     """Makes a cloropleth map and a legend from a panda series and a blank svg map. 
     Assumes the index of the series matches the SVG classes
-    Saves the map in SVG, and in PNG if Inkscape is installed.
+    Saves the map in SVG and PNG (at dpi), the legend in PNG, and both together in PNG.
+    Returns the path of the latter (shown as an image in notebooks, see preview). The SVG and missing regions are reported to the progress backend.
     if provided, new_title sets the title for the new SVG map
+    The blank map is parsed once per file (see SvgMapTemplate).
+    PNGs are drawn in memory (backend: see SvgMapTemplate.raster), without temporary files, so maps can be made by many processes at once.
+    simplify: if True, the regions are simplified as far as it does not show at dpi (in the SVG too, see svg_map_template).
     """
     
-    #simplifies the index to lower case without space
-    series_in.index = series_in.index.str.lower().str.replace(" ","_").str.replace("-","_").str.replace(".","_").str.replace("(","_").str.replace(")","_")
+    color_maper = colormap(color_maper)
     
-    #compute the colors 
-    color = data_to_rgb(series_in,color_maper=color_maper)
-
-    #Builds the CCS style for the new map  (todo: this step could get its own function)
-    style_base =\
-    """.{depname}
-    {{  
-       fill: {color};
-       stroke:#000000;
-       stroke-width:2;
-    }}"""
-
-    #Default style (for regions which are not in series_in)
-    style =\
-    """.default
-    {
-    fill: #bdbdbd;
-    stroke:#ffffff;
-    stroke-width:2;
-    }
-    """
+    #simplifies the index to lower case without space
+    series_in.index = normalize_place_names(series_in.index)
     
-    #builds the style line by line (using lower case identifiers)
-    for c in series_in.index:
-        style= style       + style_base.format(depname=c,color=color[c])+ "\n"   
-
     #output file name
     target_name = outfolder+"map_of_"+outname
 
-    #read input 
-    with open(svg_file_path, 'r',encoding='utf8') as svgfile: #MIND UTF8
-        soup=BeautifulSoup(svgfile.read(),"xml")
-
-    #names of regions to lower case without space   
-    for p in soup.findAll("path"):
-        p["class"]=p["class"].lower().replace(" ","_").replace("-","_").replace(".","_").replace("(","_").replace(")","_")
-        #Update the title (tooltip) of each region with the numerical value (ignores missing values)
-        try:
-            p.title.string += "{val:.3%}".format(val=series_in[p["class"]])
-        except:
-            pass
-   
-    #remove the existing style attribute (unimportant)
-    del soup.svg["style"]
+    #fills the blank map
+    template = svg_map_template(svg_file_path)
+    if simplify:
+        template = svg_map_template(svg_file_path, pixels=template.width*dpi/96)
+    template.render(series_in, target_name+".svg", color_maper=color_maper, new_title=new_title)
     
-    #append style
-    soup.style.string = style
-    
-    #Maybe update the title
-    if new_title is not None:
-        soup.title.string = new_title
-    else:
+    if new_title is None:
         new_title = ""
-        
-    #write output
-    with open(target_name+".svg", 'w', encoding="utf-8") as svgfile:
-        svgfile.write(soup.prettify())
-        
    
     #Link to SVG
-    display(HTML("<a target='_blank' href='"+target_name+".svg"+"'>SVG "+new_title+"</a>"))  #Linking to SVG instead of showing SVG directly works around a bug in the notebook where style-based colouring colors all the maps in the NB with a single color scale (due to CSS)
+    get_progress_backend().link(target_name+".svg", "SVG "+new_title)  #Linking to SVG instead of showing SVG directly works around a bug in the notebook where style-based colouring colors all the maps in the NB with a single color scale (due to CSS)
     
     
     #reports missing data        
     if verbose:        
-        places_in_soup = [p["class"] for p in soup.findAll("path")]        
+        places_in_soup = template.places
         data_missing_in_svg = series_in[~series_in.index.isin(places_in_soup)].index.tolist()
         data_missing_in_series = [p for p in places_in_soup if (p not in series_in.index.tolist())]
         
         back_to_title = lambda x: x.replace("_"," ").title()
     
         if data_missing_in_svg:
-            print("Missing in SVG: "+"; ".join(map(back_to_title,data_missing_in_svg)))
+            get_progress_backend().message("Missing in SVG: "+"; ".join(map(back_to_title,data_missing_in_svg)))
         if data_missing_in_series:
-            print("Missing in series: "+"; ".join(map(back_to_title,data_missing_in_series)))
+            get_progress_backend().message("Missing in series: "+"; ".join(map(back_to_title,data_missing_in_series)))
 
-    if shutil.which("inkscape") is None:
-        print("cannot convert SVG to PNG. Install Inkscape to do so.")
-        could_do_png_map = False
-    else:
-        #Attempts to inkscape SVG to PNG    
-        process=Popen("inkscape -f {map}.svg -e {map}.png -d 150".format(map=target_name, outfolder = outfolder) , shell=True, stdout=PIPE,   stderr=PIPE)
-        out, err = process.communicate()
-        errcode = process.returncode
-        if errcode:
-            could_do_png_map = False
-            print("Could not transform SVG to PNG. Error message was:\n"+err.decode())
-        else:
-            could_do_png_map = True
+    #draws the map and the legend in memory, and writes them with the map over the legend (resized to img_width)
+    map_image = template.raster(series_in, color_maper=color_maper, dpi=dpi, backend=backend)
+    map_image.save(target_name+".png")
+    
+    legend_image = figure_to_image(legend_figure(100*series_in,color_maper,label), bbox_inches="tight", transparent=True)
+    legend_image.save(outfolder+"legend_of_"+outname+".png")
+    
+    merged_path = outfolder+"map_and_legend_of_{outname}.png".format(outname=outname)
+    stack_images([map_image, legend_image], img_width).save(merged_path)
+    
+    return preview(merged_path)
 
-    #makes the legend with matplotlib
-    l = make_legend(100*series_in,color_maper,label,outfolder+"legend_of_"+outname)
+def preview(path, width=None):
+    """The image at path as an IPython Image in a notebook (so it shows as the output of the cell), the path itself elsewhere"""
+    if not in_notebook():
+        return path
+    from IPython.display import Image  #only needed in notebooks
+    return Image(path, width=width)
+        
+    
+class SvgMapTemplate:
+    """Blank svg map, parsed once to make any number of cloropleth maps.
+    The map is serialized once with placeholders for the style, the title and the tooltip of each region, and split on them:
+    rendering a map only formats the style and the tooltips and joins the pieces.
+    
+    template = SvgMapTemplate("map/PHL_adm1.svg")
+    for c in ["risk", "resilience", "risk_to_assets"]:
+        template.render(df[c], "img/map_of_"+c+".svg", new_title=c)
+    """
+    
+    def __init__(self, svg_file_path, tolerance=0):
+        """tolerance: if positive, the regions are simplified within tolerance (in svg units, see simplify_shapes)"""
+        
+        #read input 
+        with open(svg_file_path, 'r',encoding='utf8') as svgfile: #MIND UTF8
+            soup=BeautifulSoup(svgfile.read(),"xml")
+        
+        #names of regions to lower case without space, and placeholders for their tooltips (regions without title have no tooltip)
+        self.places = []
+        tooltips = []
+        self.spaces = []
+        for p in soup.findAll("path"):
+            p["class"]=normalize_place_names(p["class"])
+            self.places.append(p["class"])
+            if p.title is not None and p.title.string is not None:
+                #the space before the value is only written with the value
+                text = p.title.string
+                self.spaces.append(text[len(text.rstrip()):] if text.strip() else "")
+                p.title.string = text.rstrip()+_placeholder(len(tooltips))
+                tooltips.append(p["class"])
+        self.tooltips = pd.Index(tooltips)
+        
+        #remove the existing style attribute (unimportant)
+        del soup.svg["style"]
+        
+        #outlines of the regions (parsed when first drawn, see shapes), and size of the map (in svg units)
+        self.outlines = [p["d"] for p in soup.findAll("path")]
+        if tolerance>0:
+            self.outlines = svg_outlines(*simplify_shapes(*svg_rings(self.outlines), tolerance))
+            for p, d in zip(soup.findAll("path"), self.outlines):
+                p["d"] = d
+        self._shapes = None
+        self.width, self.height = [float(x) for x in soup.svg["viewBox"].split()[2:]]
+        
+        self.title = soup.title.string if soup.title is not None else None
+        soup.style.string = _placeholder("style")
+        if soup.title is not None:
+            soup.title.string = _placeholder("title")
+        
+        #pieces of the serialized map, between placeholders: text, then (space before the placeholder, name of the placeholder) pairs
+        self.parts = re.split("(\\s*)"+_placeholder("(\\w+)"), soup.prettify())
     
-    if shutil.which("convert") is None:
-        print("Cannot merge map and legend. Install ImageMagick® to do so.")
-    elif could_do_png_map:
-        #Attempts to downsize to a single width and concatenate using imagemagick
-        call("convert "+outfolder+"legend_of_{outname}.png -resize {w} small_legend.png".format(outname=outname,w=img_width), shell=True )
-        call("convert "+outfolder+"map_of_{outname}.png -resize {w} small_map.png".format(outname=outname,w=img_width) , shell=True)
+    def render(self, series_in, path=None, color_maper=None, new_title=None):
+        """The map of series_in (indexed by region, see make_map_from_svg), as a string. Saved as path, if provided.
+        new_title: replaces the title of the map."""
+        
+        series_in = pd.Series(series_in.values, index=normalize_place_names(series_in.index))
+        
+        #compute the colors 
+        color = data_to_rgb(series_in,color_maper=colormap(color_maper))
+        
+        #(prettify strips the ends of texts)
+        values = dict(style=escape(map_style(color).strip()), title=escape(((self.title if new_title is None else new_title) or "").strip()))
+        
+        #tooltips of each region with the numerical value (unchanged for regions not in series_in)
+        numbers = series_in[~series_in.index.duplicated()].reindex(self.tooltips)
+        known = self.tooltips.isin(series_in.index)
+        for i, (v, k, space) in enumerate(zip(numbers.values, known, self.spaces)):
+            values[str(i)] = space+"{val:.3%}".format(val=v) if k else ""
         
-        merged_path = outfolder+"map_and_legend_of_{outname}.png".format(outname=outname)
+        #(empty values are written without the space before them)
+        parts = self.parts[:]
+        for i in range(1, len(parts), 3):
+            value = values[parts[i+1]]
+            parts[i+1] = value
+            if not value:
+                parts[i] = ""
+        svg = "".join(parts)
         
-        call("convert -append small_map.png small_legend.png "+merged_path, shell=True)
+        if path is not None:
+            with open(path, 'w', encoding="utf-8") as svgfile:
+                svgfile.write(svg)
         
-        #removes temp files
-        if os.path.isfile("small_map.png"):
-            os.remove("small_map.png")
-        if os.path.isfile("small_legend.png"):
-            os.remove("small_legend.png")
+        return svg
     
-        if os.path.isfile(merged_path):
-            return Image(merged_path)
+    @property
+    def shapes(self):
+        """matplotlib Paths of the regions (see svg_path), in the order of places"""
+        if self._shapes is None:
+            self._shapes = [svg_path(d) for d in self.outlines]
+        return self._shapes
+    
+    def raster(self, series_in, color_maper=None, dpi=150, backend=None):
+        """The map of series_in (see render) as a PIL image with a transparent background, at dpi (the svg is at 96 dpi).
+        backend: "cairosvg" (draws the svg of render) or "matplotlib" (draws the regions with the colors of render, see shapes).
+        Defaults to cairosvg if it can be loaded (it needs the cairo library), matplotlib otherwise (see raster_backend)."""
+        
+        if backend is None:
+            backend = raster_backend()
+        
+        if backend=="cairosvg":
+            import cairosvg  #optional
+            png = cairosvg.svg2png(bytestring=self.render(series_in, color_maper=color_maper).encode("utf-8"), scale=dpi/96)
+            return PIL.Image.open(io.BytesIO(png)).convert("RGBA")
+        
+        if backend!="matplotlib":
+            raise ValueError("unknown raster backend: "+str(backend))
+        
+        series_in = pd.Series(series_in.values, index=normalize_place_names(series_in.index))
+        color = data_to_rgb(series_in,color_maper=colormap(color_maper))
+        color = color[~color.index.duplicated()]
         
+        #same style as the svg (see map_style)
+        known = pd.Index(self.places).isin(color.index)
+        fill = np.where(known, color.reindex(self.places).values, "#bdbdbd")
+        stroke = np.where(known, "#000000", "#ffffff")
+        
+        fig = Figure(figsize=(self.width/96, self.height/96), dpi=dpi)
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.set_axis_off()
+        ax.set_xlim(0, self.width)
+        ax.set_ylim(self.height, 0)
+        
+        #stroke-width is 2 svg units (1.5 points)
+        ax.add_collection(PathCollection(self.shapes, facecolors=fill, edgecolors=stroke, linewidths=1.5))
+        
+        return figure_to_image(fig, transparent=True)
+    
+    def render_all(self, df, outfolder="img/", color_maper=None, titles=None):
+        """One map per column of df, saved as outfolder/map_of_{column}.svg. titles: dict of titles of the maps, by column.
+        Returns the paths of the maps"""
+        os.makedirs(outfolder, exist_ok=True)
+        paths = []
+        for c in df.columns:
+            paths.append(os.path.join(outfolder, "map_of_{}.svg".format(c)))
+            self.render(df[c], paths[-1], color_maper=color_maper, new_title=None if titles is None else titles.get(c))
+        return paths
+
+#templates already parsed by svg_map_template, by file (and modification time)
+_svg_templates = dict()
+
+def svg_map_template(svg_file_path, pixels=None):
+    """SvgMapTemplate of svg_file_path, parsed on the first call only (and again if the file changes).
+    pixels: width of the output in pixels. If provided, the regions are simplified as far as it does not show (see detail_level)."""
+    key = (os.path.abspath(svg_file_path), os.path.getmtime(svg_file_path))
+    if key+(0,) not in _svg_templates:
+        _svg_templates[key+(0,)] = SvgMapTemplate(svg_file_path)
+    full = _svg_templates[key+(0,)]
+    
+    tolerances = [0]+[f*full.width for f in detail_levels]
+    level = detail_level(tolerances, full.width, pixels)
+    if key+(level,) not in _svg_templates:
+        _svg_templates[key+(level,)] = SvgMapTemplate(svg_file_path, tolerances[level])
+    return _svg_templates[key+(level,)]
+
+#backend of SvgMapTemplate.raster when none is given, chosen on first use if None
+_raster_backend = None
+
+def raster_backend():
+    """"cairosvg" if it can be loaded, "matplotlib" otherwise"""
+    global _raster_backend
+    if _raster_backend is None:
+        try:
+            import cairosvg
+            _raster_backend = "cairosvg"
+        except (ImportError, OSError):  #OSError if the cairo library is missing
+            _raster_backend = "matplotlib"
+    return _raster_backend
+
+def svg_path(d):
+    """matplotlib Path of the d attribute of a svg path made of absolute moveto, lineto and closepath commands (as the maps in map/)"""
+    vertices = []
+    codes = []
+    for command, numbers in re.findall("([A-Za-z])([^A-Za-z]*)", d):
+        xy = np.array(re.findall(_svg_number, numbers), dtype=float).reshape(-1, 2)
+        if command=="M":
+            codes += [Path.MOVETO]+[Path.LINETO]*(len(xy)-1)
+        elif command=="L":
+            codes += [Path.LINETO]*len(xy)
+        elif command in "Zz":
+            xy = np.zeros((1, 2))
+            codes.append(Path.CLOSEPOLY)
+        else:
+            raise ValueError("unsupported svg path command: "+command)
+        vertices.append(xy)
+    return Path(np.concatenate(vertices), codes)
+
+def svg_rings(outlines):
+    """Polygons of svg paths (d attributes made of closed subpaths, see svg_path), in the format of read_shapefile"""
+    xy, rings, parts = [], [0], [0]
+    for d in outlines:
+        for subpath in re.findall("[Mm][^Mm]*", d):
+            ring = np.array(re.findall(_svg_number, subpath), dtype=float).reshape(-1, 2)
+            if (ring[0]!=ring[-1]).any():
+                ring = np.r_[ring, ring[:1]]
+            xy.append(ring)
+            rings.append(rings[-1]+len(ring))
+        parts.append(len(rings)-1)
+    return np.concatenate(xy), np.array(rings), np.array(parts)
+
+def svg_outlines(xy, rings, parts):
+    """d attributes of svg paths from polygons in the format of read_shapefile (inverse of svg_rings)"""
+    outlines = []
+    for first, last in zip(parts[:-1], parts[1:]):
+        outlines.append("".join("M"+"L".join("{:.6f},{:.6f}".format(x, y) for x, y in xy[rings[r]:rings[r+1]])+"Z " for r in range(first, last)))
+    return outlines
+
+#numbers in svg paths
+_svg_number = "-?(?:\\d+\\.?\\d*|\\.\\d+)(?:[eE][-+]?\\d+)?"
+
+def figure_to_image(fig, **kwargs):
+    """Matplotlib figure as a PIL image (RGBA). kwargs: passed to savefig"""
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", **kwargs)
+    buffer.seek(0)
+    return PIL.Image.open(buffer).convert("RGBA")
+
+def stack_images(images, width=img_width):
+    """PIL images resized to width and stacked from top to bottom, as one PIL image"""
+    images = [i.resize((width, max(1, round(i.height*width/i.width))), PIL.Image.LANCZOS) for i in images]
+    out = PIL.Image.new("RGBA", (width, sum(i.height for i in images)), (255, 255, 255, 0))
+    top = 0
+    for i in images:
+        out.paste(i, (0, top))
+        top += i.height
+    return out
+
+def normalize_place_names(names):
+    """Region names (a string or an index) to lower case, with _ instead of spaces, dashes, dots and brackets (as the classes of the maps)"""
+    if isinstance(names, str):
+        return names.lower().replace(" ","_").replace("-","_").replace(".","_").replace("(","_").replace(")","_")
+    return pd.Index([normalize_place_names(n) for n in names], name=names.name)
+
+def map_style(color):
+    """CSS of a map: a default style, then one class per region (index of color) with its color"""
+    
+    #Default style (for regions which are not in series_in)
+    style =\
+    """.default
+    {
+    fill: #bdbdbd;
+    stroke:#ffffff;
+    stroke-width:2;
+    }
+    """
+    
+    style_base =\
+    """.{depname}
+    {{  
+       fill: {color};
+       stroke:#000000;
+       stroke-width:2;
+    }}"""
+    
+    #one class per line (using lower case identifiers)
+    return style + "".join(style_base.format(depname=c,color=color[c])+ "\n" for c in color.index)
+
+def _placeholder(name):
+    return "@@svgmap_{}@@".format(name)
     
 import matplotlib as mpl
 
 def make_legend(serie,cmap,label="",path=None):
     #todo: log flag
+    
+    fig = legend_figure(serie,cmap,label)
+    if path is not None:
+        fig.savefig(path+".png",bbox_inches="tight",transparent=True)  
+    
+    return preview(path+".png", width=img_width)
 
+def legend_figure(serie,cmap,label=""):
+    #colorbar from the min to the max of serie (a Figure, not managed by pyplot)
     
-    fig = plt.figure(figsize=(8,3))
+    fig = Figure(figsize=(8,3))
     ax1 = fig.add_axes([0.05, 0.80, 0.9, 0.15])
 
     vmin=serie.min()
@@ -159,12 +372,8 @@ def make_legend(serie,cmap,label="",path=None):
     cb = mpl.colorbar.ColorbarBase(ax1, cmap=cmap, norm=norm, orientation='horizontal')
     #cb.ax.set_xticklabels(['0.01%','0.1%','1%','10%'])
     cb.set_label(label)
-    if path is not None:
-        plt.savefig(path+".png",bbox_inches="tight",transparent=True)  
-    plt.close(fig)    
-    
     
-    return Image(path+".png", width=img_width   )  
+    return fig
 
     
 def n_to_one_normalizer(s,n=0):
@@ -188,17 +397,383 @@ def num_to_hex(x):
         h="0"+h
     return h
 
-def data_to_rgb(serie,color_maper=plt.cm.get_cmap("Blues_r"), normalizer = n_to_one_normalizer, norm_param = 0, na_color = "#e0e0e0"):
-    """This functions transforms  data series into a series of color, using a colormap."""
+def data_to_rgb(serie,color_maper=None, normalizer = n_to_one_normalizer, norm_param = 0, na_color = "#e0e0e0"):
+    """This functions transforms  data series into a series of color, using a colormap (Blues_r by default).
+    Colors are read in a table of the colormap's colors (see color_table)."""
+
+    color_maper = colormap(color_maper, "Blues_r")
+
+    data_n = np.asarray(normalizer(serie,norm_param), dtype=float)
+
+    table = color_table(color_maper)
+    if table is None:
+        #not a matplotlib colormap: colors of each value
+        out = rgb_to_hex(color_maper(data_n))
+    else:
+        #bin of each value in the colormap, as matplotlib picks it (0 and N+1 for values below 0 and above 1, N+2 for nans)
+        n = len(table)-3
+        with np.errstate(invalid="ignore"):
+            bins = np.floor(np.where(data_n==1, n-1, data_n*n))
+        bins = np.where(np.isnan(bins), n+1, np.clip(np.nan_to_num(bins), -1, n)).astype(int)+1
+        out = table[bins]
+
+    out[np.asarray(serie.isnull())] = na_color.upper()
+    return pd.Series(out, index=serie.index)
+
+def colormap(color_maper, default="Blues"):
+    """color_maper, or the matplotlib colormap called default if None (looked up when used: plt.cm.get_cmap is gone from recent matplotlib)"""
+    return mpl.colormaps[default] if color_maper is None else color_maper
+
+#tables of color_table, by id of colormap (with the colormap, to check the id is not reused)
+_color_tables = dict()
+
+def color_table(color_maper):
+    """Colors of a matplotlib colormap as hex strings ("#RRGGBB"): the color below 0, its N colors, the color above 1, the color of nans. Computed once per colormap.
+    None if color_maper is not a colormap."""
+    if not isinstance(color_maper, mpl.colors.Colormap):
+        return None
+    cached = _color_tables.get(id(color_maper))
+    if cached is None or cached[0] is not color_maper:
+        n = color_maper.N
+        cached = color_maper, rgb_to_hex(color_maper(np.r_[-1, (np.arange(n)+0.5)/n, 2, np.nan]))
+        _color_tables[id(color_maper)] = cached
+    return cached[1]
+
+def rgb_to_hex(rgba):
+    """Array of colors (as returned by colormaps, values from 0 to 1) to an array of hex strings ("#RRGGBB", see num_to_hex)"""
+    rgb = (255*np.asarray(rgba)[...,:3]).astype(int)
+    return np.char.mod("#%06X", (rgb[...,0]<<16)|(rgb[...,1]<<8)|rgb[...,2]).astype(object)
+
+
+############################################################################# 
+#######################       FROM SHAPEFILE          ####################### 
+#############################################################################     
+
+import struct, hashlib
+from matplotlib.collections import PolyCollection
+from data_loading import file_digest
+
+class ShapeMap:
+    """Cloropleth maps drawn from a shapefile: the regions are a single PolyCollection (one compound polygon per region, holes included), 
+    which is only recolored for each series. The geometries are read, projected and cached once (see load_shapes).
+    
+    m = ShapeMap("inputs/PHL_adm1.shp")
+    for c in ["risk", "resilience", "risk_to_assets"]:
+        m.save(df[c], "img/shapemap_of_"+c+".png")
+    """
+    
+    def __init__(self, shp_path="inputs/PHL_adm1.shp", name_field="NAME_1", width=5, dpi=150, linewidth=0.5, simplify=True, cache_dir=None):
+        """name_field: column of the .dbf with the names of the regions (normalized as the classes of the svg maps, see normalize_place_names).
+        width: in inches. dpi: default resolution of the images.
+        simplify: if True, maps are drawn with the coarsest level of detail that does not show at their dpi (see detail_level)."""
+        
+        geometry = load_shapes(shp_path, name_field, cache_dir=cache_dir)
+        self.places = normalize_place_names(pd.Index(geometry["names"]))
+        self.dpi = dpi
+        self.simplify = simplify
+        self.levels = geometry["levels"]
+        self.tolerances = geometry["tolerances"]
+        self._paths = dict()
+        
+        xy = geometry["xy"]
+        (xmin, ymin), (xmax, ymax) = xy.min(axis=0), xy.max(axis=0)
+        self.extent = xmax-xmin
+        self.figure = Figure(figsize=(width, width*(ymax-ymin)/(xmax-xmin)), dpi=dpi)
+        ax = self.figure.add_axes([0, 0, 1, 1])
+        ax.set_axis_off()
+        ax.set_xlim(xmin, xmax)
+        ax.set_ylim(ymin, ymax)
+        
+        self.collection = PolyCollection([], linewidths=linewidth)
+        ax.add_collection(self.collection)
+        self.level = None
+        self.use_level(self.detail(dpi))
+    
+    def detail(self, dpi=None):
+        """Level of detail used at dpi"""
+        if not self.simplify:
+            return 0
+        return detail_level(self.tolerances, self.extent, self.figure.get_figwidth()*(self.dpi if dpi is None else dpi))
+    
+    def use_level(self, level):
+        """Draws the regions at a level of detail (0 is the full detail, see load_shapes)"""
+        if level==self.level:
+            return
+        if level not in self._paths:
+            #one path per region, with a moveto at the start of each of its rings (vertices are views on the cached buffer)
+            xy, rings, parts = [self.levels[level][k] for k in ["xy", "rings", "parts"]]
+            verts, codes = [], []
+            for first, last in zip(parts[:-1], parts[1:]):
+                start = rings[first]
+                c = np.full(rings[last]-start, Path.LINETO, dtype=Path.code_type)
+                c[rings[first:last]-start] = Path.MOVETO
+                verts.append(xy[start:rings[last]])
+                codes.append(c)
+            self._paths[level] = verts, codes
+        self.collection.set_verts_and_codes(*self._paths[level])
+        self.level = level
+    
+    def draw(self, series_in, color_maper=None, dpi=None):
+        """Colors the regions with series_in (indexed by region), as make_map_from_svg does, at the level of detail of dpi"""
+        
+        self.use_level(self.detail(dpi))
+        
+        series_in = pd.Series(series_in.values, index=normalize_place_names(series_in.index))
+        color = data_to_rgb(series_in,color_maper=colormap(color_maper))
+        color = color[~color.index.duplicated()]
+        
+        #same style as the svg maps (see map_style)
+        known = self.places.isin(color.index)
+        self.collection.set_facecolor(np.where(known, color.reindex(self.places).values, "#bdbdbd"))
+        self.collection.set_edgecolor(np.where(known, "#000000", "#ffffff"))
+        return self.figure
+    
+    def save(self, series_in, path, color_maper=None, dpi=None, **kwargs):
+        """Saves the map of series_in as path (png, pdf, svg...) with a transparent background. kwargs: passed to savefig"""
+        self.draw(series_in, color_maper, dpi)
+        self.figure.savefig(path, dpi=self.dpi if dpi is None else dpi, transparent=True, **kwargs)
+    
+    def image(self, series_in, color_maper=None, dpi=None):
+        """The map of series_in as a PIL image"""
+        self.draw(series_in, color_maper, dpi)
+        return figure_to_image(self.figure, dpi=self.dpi if dpi is None else dpi, transparent=True)
+    
+    def save_all(self, df, outfolder="img/", color_maper=None, format="png", dpi=None):
+        """One map per column of df, saved as outfolder/shapemap_of_{column}.{format}. Returns the paths of the maps"""
+        os.makedirs(outfolder, exist_ok=True)
+        paths = []
+        for c in df.columns:
+            paths.append(os.path.join(outfolder, "shapemap_of_{}.{}".format(c, format)))
+            self.save(df[c], paths[-1], color_maper=color_maper, dpi=dpi)
+        return paths
+
+
+def load_shapes(shp_path, name_field="NAME_1", projection=None, levels=None, cache_dir=None):
+    """Polygons of a shapefile (see read_shapefile), projected (see equirectangular) and simplified at several levels of detail, from a cache after the first time.
+    levels: tolerances of the simplified levels, as fractions of the width of the map (defaults to detail_levels, see simplify_shapes).
+    Returns a dict with names, xy, rings, parts (full detail), tolerances (in map units, 0 first) and levels (xy, rings and parts of each level, full detail first).
+    The cache is a .npz file with the coordinates as float32, reused as long as the .shp and .dbf files have the same modification times and sizes, or else the same content (sha1).
+    cache_dir: defaults to a __cache__ folder next to the shapefile."""
+    
+    if projection is None:
+        projection = equirectangular
+    if levels is None:
+        levels = detail_levels
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(shp_path), "__cache__")
+    
+    #one cache per file and way of reading it
+    call = repr((name_field, projection.__name__, list(levels)))
+    cache_file = os.path.join(cache_dir, os.path.basename(shp_path)+"-"+hashlib.sha1(call.encode()).hexdigest()[:10]+".npz")
+    
+    sources = [shp_path, os.path.splitext(shp_path)[0]+".dbf"]
+    stats = [os.stat(f) for f in sources]
+    stamp = np.array([[s.st_mtime, s.st_size] for s in stats])
+    
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            if np.array_equal(cached["stamp"], stamp) or str(cached["sha1"])==_sources_digest(sources):
+                return _shapes_levels(dict(cached))
+    
+    names, xy, rings, parts = read_shapefile(shp_path, name_field)
+    shapes = dict(names=np.array(names), xy=projection(xy).astype(np.float32), rings=rings, parts=parts)
+    
+    width = np.ptp(shapes["xy"][:,0])
+    shapes["tolerances"] = np.array([0]+[f*width for f in levels])
+    for i, tolerance in enumerate(shapes["tolerances"][1:], 1):
+        shapes["xy{}".format(i)], shapes["rings{}".format(i)], shapes["parts{}".format(i)] = simplify_shapes(shapes["xy"], rings, parts, tolerance)
+    
+    #written under a temporary name, so that processes reading the cache never see it half written
+    os.makedirs(cache_dir, exist_ok=True)
+    temp = "{}.{}.tmp".format(cache_file, os.getpid())
+    with open(temp, "wb") as f:
+        np.savez(f, stamp=stamp, sha1=_sources_digest(sources), **shapes)
+    os.replace(temp, cache_file)
+    
+    return _shapes_levels(shapes)
+
+def _shapes_levels(shapes):
+    #arrays of each level (xy1, rings1, parts1, ...) as a list of dicts, full detail first
+    out = {k: shapes[k] for k in ["names", "xy", "rings", "parts", "tolerances"]}
+    out["levels"] = [{k: shapes[k+("{}".format(i) if i else "")] for k in ["xy", "rings", "parts"]} for i in range(len(out["tolerances"]))]
+    return out
+
+def _sources_digest(sources):
+    return "-".join(file_digest(f) for f in sources)
+
+def equirectangular(lonlat):
+    """Projects (longitude, latitude) coordinates (in degrees) to (x, y), with x scaled by the cosine of the middle latitude (suits small countries)"""
+    lat0 = np.radians((lonlat[:,1].min()+lonlat[:,1].max())/2)
+    return np.column_stack([lonlat[:,0]*np.cos(lat0), lonlat[:,1]])
+
+def read_shapefile(shp_path, name_field="NAME_1", encoding="latin-1"):
+    """Polygons of a shapefile, with their names (name_field in the .dbf next to it). Returns (names, xy, rings, parts):
+    xy: coordinates of all the rings, one after the other. Ring i is xy[rings[i]:rings[i+1]]. The rings of shape j are rings parts[j] to parts[j+1]."""
+    
+    with open(shp_path, "rb") as f:
+        data = f.read()
+    
+    xy = []
+    rings = [0]
+    parts = [0]
+    pos = 100  #after the file header
+    while pos<len(data):
+        #record header (big endian, length in 16 bits words), then content (little endian)
+        length = 2*struct.unpack(">i", data[pos+4:pos+8])[0]
+        content = data[pos+8:pos+8+length]
+        pos += 8+length
+        
+        shape_type = struct.unpack("<i", content[:4])[0]
+        if shape_type in (5, 15, 25):  #polygon (z and m values are ignored)
+            n_parts, n_points = struct.unpack("<ii", content[36:44])
+            starts = np.frombuffer(content, "<i4", n_parts, 44)
+            xy.append(np.frombuffer(content, "<f8", 2*n_points, 44+4*n_parts).reshape(-1, 2))
+            rings += (rings[-1]+np.append(starts[1:], n_points)).tolist()
+        elif shape_type!=0:  #null shapes have no rings
+            raise ValueError("{} has shapes of type {}, only polygons can be read".format(shp_path, shape_type))
+        parts.append(len(rings)-1)
+    
+    xy = np.concatenate(xy) if xy else np.empty((0, 2))
+    names = read_dbf_column(os.path.splitext(shp_path)[0]+".dbf", name_field, encoding)
+    return names, xy, np.array(rings), np.array(parts)
+
+def read_dbf_column(dbf_path, field, encoding="latin-1"):
+    """Values of a column of a .dbf file, as stripped strings"""
+    
+    with open(dbf_path, "rb") as f:
+        data = f.read()
+    
+    records, header, record = struct.unpack("<IHH", data[4:12])
+    
+    #field descriptors, 32 bytes each, after the deletion flag of each record
+    offset = 1
+    for pos in range(32, header-1, 32):
+        name = data[pos:pos+11].split(b"\0")[0].decode("ascii")
+        size = data[pos+16]
+        if name==field:
+            break
+        offset += size
+    else:
+        raise KeyError("{} is not a column of {}".format(field, dbf_path))
+    
+    start = header+offset
+    return [data[start+i*record:start+i*record+size].decode(encoding).strip() for i in range(records)]
+
 
-    data_n = normalizer(serie,norm_param)
+############################################################################# 
+#######################      LEVELS OF DETAIL         ####################### 
+#############################################################################     
 
-    #here matplolib color mappers will just fill nas with the lowest color in the colormap
-    colors = pd.DataFrame(color_maper(data_n),index=serie.index, columns=["r","g","b","a"]).applymap(num_to_hex)
+#tolerances of the simplified levels of detail of the maps, as fractions of the width of the map (level 0 is the full detail)
+detail_levels = [1/8000, 1/4000, 1/2000, 1/1000, 1/500, 1/250]
 
-    out = "#"+colors.r+colors.g+colors.b
-    out[serie.isnull()]=na_color
-    return out.str.upper()
+def detail_level(tolerances, width, pixels):
+    """Index of the coarsest level of detail (tolerances in map units, increasing, 0 for the full detail) that stays within half a pixel of the full detail
+    when the width of the map (in map units) is drawn on pixels. Full detail if pixels is None."""
+    if pixels is None:
+        return 0
+    return int(np.flatnonzero(np.asarray(tolerances)<=0.5*width/pixels)[-1])
 
+def simplify_shapes(xy, rings, parts, tolerance):
+    """Polygons (in the format of read_shapefile) simplified with the Douglas-Peucker algorithm, within tolerance of the originals.
+    Boundaries shared by neighbouring regions are simplified once, so that neighbours still fit without gaps or overlaps:
+    rings are split into arcs where the rings they share a border with change, and equal arcs get the same points.
+    Rings that are not shared and shrink to less than three points are dropped, unless they are the last ring of their shape.
+    Returns (xy, rings, parts)"""
+    
+    if tolerance<=0:
+        return xy, rings, parts
+    
+    #rings must be closed (last point equal to the first)
+    points, ids = np.unique(xy, axis=0, return_inverse=True)
+    ids = ids.ravel()
+    n_rings = len(rings)-1
+    ring_of_point = np.repeat(np.arange(n_rings), np.diff(rings))
+    
+    #rings sharing each edge (identified by its ends): count, first and last ring, compared along each ring
+    inner = np.ones(len(ids)-1, dtype=bool)
+    inner[rings[1:-1]-1] = False  #from the last point of a ring to the first of the next
+    edge = np.minimum(ids[:-1], ids[1:])*len(points)+np.maximum(ids[:-1], ids[1:])
+    edge_ring = ring_of_point[:-1]
+    order = np.lexsort((edge_ring[inner], edge[inner]))
+    sorted_keys = edge[inner][order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:]!=sorted_keys[:-1]])
+    keys = sorted_keys[starts]
+    ring_min = edge_ring[inner][order][starts]
+    ring_max = np.maximum.reduceat(edge_ring[inner][order], starts)
+    count = np.diff(np.r_[starts, len(sorted_keys)])
+    
+    which = np.minimum(np.searchsorted(keys, edge), len(keys)-1)
+    signature = np.where(inner, (count[which]*(n_rings+1)+ring_min[which])*(n_rings+1)+ring_max[which], -1)
+    shared = np.where(inner, count[which]>1, False)
+    
+    simplified = dict()
+    new_xy, new_rings, new_parts = [], [0], [0]
+    for s in range(len(parts)-1):
+        kept = []
+        for r in range(parts[s], parts[s+1]):
+            ring = _simplify_ring(ids[rings[r]:rings[r+1]], signature[rings[r]:rings[r+1]-1], points, tolerance, simplified)
+            kept.append((ring, shared[rings[r]:rings[r+1]-1].any()))
+        
+        for i, (ring, is_shared) in enumerate(kept):
+            last = i==len(kept)-1 and len(new_rings)-1==new_parts[-1]
+            if len(ring)<4 and not is_shared and not last:
+                continue
+            new_xy.append(points[ring])
+            new_rings.append(new_rings[-1]+len(ring))
+        new_parts.append(len(new_rings)-1)
+    
+    xy = np.concatenate(new_xy).astype(xy.dtype) if new_xy else xy[:0]
+    return xy, np.array(new_rings), np.array(new_parts)
+
+def _simplify_ring(ids, signature, points, tolerance, simplified):
+    """Points (ids) of a closed ring after simplification. signature: rings sharing each edge. simplified: arcs already simplified, by arc"""
+    
+    #nodes: where the rings sharing the edges change
+    nodes = np.flatnonzero(signature!=np.roll(signature, 1))
+    if len(nodes)==0:
+        #same arcs in all the rings with these points: from their smallest point to the point farthest from it, and back
+        start = np.argmin(ids[:-1])
+        far = np.argmax(np.hypot(*(points[ids[:-1]]-points[ids[start]]).T))
+        nodes = np.unique([start, far])
+    
+    #rotated to start at a node, with the first node again at the end
+    ring = np.r_[ids[nodes[0]:-1], ids[:nodes[0]+1]]
+    nodes = np.r_[nodes-nodes[0], len(ids)-1]
+    
+    out = [ring[:1]]
+    for a, b in zip(nodes[:-1], nodes[1:]):
+        arc = ring[a:b+1]
+        
+        #each arc is simplified in one direction, so that the rings on both sides get the same points
+        reverse = tuple(arc[::-1])<tuple(arc)
+        key = tuple(arc[::-1]) if reverse else tuple(arc)
+        if key not in simplified:
+            line = np.array(key)
+            simplified[key] = line[douglas_peucker(points[line], tolerance)]
+        kept = simplified[key][::-1] if reverse else simplified[key]
+        out.append(kept[1:])
+    
+    return np.concatenate(out)
 
-    
\ No newline at end of file
+def douglas_peucker(line, tolerance):
+    """Indices of the points of line (an (n, 2) array) kept by the Douglas-Peucker algorithm: the ends, and the points that are needed to stay within tolerance"""
+    keep = np.zeros(len(line), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(line)-1)]
+    while stack:
+        i, j = stack.pop()
+        if j<=i+1:
+            continue
+        segment = line[j]-line[i]
+        offsets = line[i+1:j]-line[i]
+        length = np.hypot(*segment)
+        if length>0:
+            distance = np.abs(segment[0]*offsets[:,1]-segment[1]*offsets[:,0])/length
+        else:
+            distance = np.hypot(offsets[:,0], offsets[:,1])
+        k = np.argmax(distance)
+        if distance[k]>tolerance:
+            keep[i+1+k] = True
+            stack += [(i, i+1+k), (i+1+k, j)]
+    return np.flatnonzero(keep)
@@ -0,0 +1,106 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from res_ind_lib import compute_resiliences, interpolate_faratios
+from res_ind_kernel import MODEL_OUTPUTS
+
+def parallel_compute_resiliences(df_in, fa_ratios=None, multihazard_data=None, workers=None, level=None, chunks=None, **kwargs):
+    """compute_resiliences evaluated in parallel on blocks of provinces or scenarios, in a pool of processes.
+    The numeric columns of df_in and the outputs live in shared memory: workers only receive the row range of their chunk.
+    Results are in the order of df_in, and equal to those of compute_resiliences.
+    workers: number of processes (defaults to the number of cores). With one worker, runs in this process.
+    level: index level whose values are never split across chunks. Defaults to "scenario" if df_in has it, "province" otherwise.
+    chunks: number of chunks (see chunk_bounds).
+    kwargs: passed to compute_resiliences (engine, integration)"""
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if level is None:
+        level = "scenario" if "scenario" in df_in.index.names else "province"
+
+    #the return periods include the protection levels of all provinces (see interpolate_faratios), not only those of the chunk
+    if fa_ratios is not None and "scenario" not in df_in.index.names:
+        fa_ratios = interpolate_faratios(fa_ratios, df_in.protection.unique().tolist())
+
+    #rows of the same block next to each other
+    blocks, _ = pd.factorize(df_in.index.get_level_values(level))
+    order = np.argsort(blocks, kind="stable")
+    numeric = df_in.select_dtypes("number")
+    index = df_in.index[order]
+
+    bounds = chunk_bounds(blocks[order], workers, chunks)
+
+    if workers==1 or len(bounds)==1:
+        out = pd.concat([compute_resiliences(numeric.iloc[order[a:b]], fa_ratios, multihazard_data, **kwargs)[MODEL_OUTPUTS] for a, b in bounds])
+        return _assemble(df_in, out.values, order)
+
+    shm_in = shared_memory.SharedMemory(create=True, size=max(1, 8*numeric.size))
+    shm_out = shared_memory.SharedMemory(create=True, size=max(1, 8*len(df_in)*len(MODEL_OUTPUTS)))
+    try:
+        np.ndarray(numeric.shape, dtype=np.float64, buffer=shm_in.buf)[:] = numeric.values[order]
+
+        with ProcessPoolExecutor(workers, initializer=_init_worker,
+                initargs=(shm_in.name, shm_out.name, numeric.columns.tolist(), index, fa_ratios, multihazard_data, kwargs)) as pool:
+            list(pool.map(_run_chunk, bounds))
+
+        outputs = np.ndarray((len(df_in), len(MODEL_OUTPUTS)), dtype=np.float64, buffer=shm_out.buf).copy()
+
+    finally:
+        for shm in (shm_in, shm_out):
+            shm.close()
+            shm.unlink()
+
+    return _assemble(df_in, outputs, order)
+
+
+def chunk_bounds(blocks, workers, chunks=None):
+    """(start, stop) rows of each chunk, cut between blocks (blocks: block number of each row, contiguous).
+    By default, aims at 4 chunks per worker to balance the load, but does not split in more chunks than blocks."""
+
+    if chunks is None:
+        chunks = 4*workers
+
+    #first row of each block, and the blocks where chunks start
+    starts = np.flatnonzero(np.r_[True, blocks[1:]!=blocks[:-1]])
+    cuts = np.unique(starts[np.linspace(0, len(starts), min(chunks, len(starts)), endpoint=False).astype(int)])
+    cuts = np.append(cuts, len(blocks))
+
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def _assemble(df_in, outputs, order):
+    """df_in with output columns, rows back in the original order"""
+    df = df_in.copy()
+    unordered = np.empty_like(outputs)
+    unordered[order] = outputs
+    for j, c in enumerate(MODEL_OUTPUTS):
+        df[c] = unordered[:, j]
+    return df
+
+
+#state of each worker process, set once by _init_worker
+_worker = dict()
+
+def _init_worker(shm_in_name, shm_out_name, columns, index, fa_ratios, multihazard_data, kwargs):
+    """Attaches the shared inputs and outputs. Small arguments (index, fa ratios, multi hazard data) are sent once per worker"""
+    shm_in = shared_memory.SharedMemory(name=shm_in_name)
+    shm_out = shared_memory.SharedMemory(name=shm_out_name)
+    _worker.update(
+        shm=(shm_in, shm_out),
+        inputs=np.ndarray((len(index), len(columns)), dtype=np.float64, buffer=shm_in.buf),
+        outputs=np.ndarray((len(index), len(MODEL_OUTPUTS)), dtype=np.float64, buffer=shm_out.buf),
+        columns=columns, index=index, fa_ratios=fa_ratios, multihazard_data=multihazard_data, kwargs=kwargs)
+
+def _run_chunk(bounds):
+    """Computes the rows start:stop and writes them in the shared outputs"""
+    start, stop = bounds
+    w = _worker
+    df = pd.DataFrame(w["inputs"][start:stop], index=w["index"][start:stop], columns=w["columns"])
+    out = compute_resiliences(df, w["fa_ratios"], w["multihazard_data"], **w["kwargs"])
+    w["outputs"][start:stop] = out[MODEL_OUTPUTS].values
+    return stop-start
@@ -1,13 +1,21 @@
 from fancy_round import *
 from progress_reporter import *
+import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.ticker import NullFormatter
+from matplotlib.backends.backend_pdf import PdfPages
 
 from subprocess import Popen  #to call other programs from python
 import sys #one function, flush, to force jupyter to print a message immediately
 import glob  #to make foldeltas, move files, etc.
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 from res_ind_lib import *
+from instrumentation import stage
 
 #height of the bars
 height = 0.40  
@@ -20,319 +28,502 @@ tinyfont= {'family' : 'sans serif','size'   : 8}
 #instructs matplotlib to use that font by default
 plt.rc('font', **font)
     
-def compute_policies(df_original,pol_increment,pol_assess_set, bounds, **kwargs):
-    
+#label of the unperturbed scenario in batched policy assessments
+baseline_scenario = "baseline"
+
+#label of the stages of batched policy assessments (see compute_policies)
+batched_label = "all policies (batched)"
+
+def compute_policies(df_original,pol_increment,pol_assess_set, bounds, batched=False, model=None, **kwargs):
+    """Effect on pol_assess_set of incrementing each input in pol_increment.index by pol_increment.
+    batched: if True, the baseline and all the perturbed inputs are stacked along a "scenario" index level and evaluated in a single call to compute_resiliences
+    Each policy is recorded as a stage when run inside instrumentation.profile_stages. Batched policies are evaluated together, so they are recorded as
+    three stages for all of them (stack_scenarios, policy and scenario_deltas, labelled batched_label) instead.
+    model: a resilience_model.ResilienceModel, used instead of compute_resiliences (and kwargs) so that the broadcast plan is only built once per protection level"""
+    
+    if model is not None:
+        compute = model.evaluate
+    else:
+        compute = lambda df: compute_resiliences(df, **kwargs)
+    
+    if batched:
+        progress_reporter("all policies (batched)")
+        with stage("stack_scenarios", df_original, label=batched_label) as s:
+            stacked = s.output(stack_scenarios(df_original,pol_increment))
+        with stage("policy", stacked, label=batched_label) as s:
+            out = s.output(compute(stacked)[pol_assess_set])
+        with stage("scenario_deltas", out, label=batched_label) as s:
+            delta = s.output(scenario_deltas(out))
+        progress_reporter("done.")       
+        return delta.stack("inputs").unstack("province").swaplevel('province', 'outputs', axis=1).sort_index(axis=1).dropna(how="all",axis=1)
+
     #initialize
     delta = pd.DataFrame(index=df_original.index, columns=pd.MultiIndex.from_product([pol_increment.index,pol_assess_set], names=['inputs', 'outputs']))
     
     #baseline
-    fx = compute_resiliences(df_original, **kwargs)[pol_assess_set]
+    with stage("policy", df_original, label=baseline_scenario) as s:
+        fx = s.output(compute(df_original)[pol_assess_set])
     
-    for var in pol_increment.index:
-        progress_reporter(var)
+    #working copy, perturbed one input at a time
+    df_=df_original.copy(deep=True)
     
-        df_=df_original.copy(deep=True)
-        
+    for var in progress(pol_increment.index, "policies"):
         #increments
-        df_[var]=df_[var]+pol_increment[var]
+        df_[var]=df_original[var]+pol_increment[var]
         
         #new value
-        fxh= compute_resiliences(df_, **kwargs)[pol_assess_set]
+        with stage("policy", df_, label=var) as s:
+            fxh= s.output(compute(df_)[pol_assess_set])
         
         #effect
         delta[var] = (fxh-fx)
-    
-    progress_reporter("done.")       
+        
+        #restores
+        df_[var]=df_original[var]
     
     return delta.stack("inputs").unstack("province").swaplevel('province', 'outputs', axis=1).sort_index(axis=1).dropna(how="all",axis=1)
     
 
-def compute_policies_mh(df_original,multi_hard_info,pol_increment_mh,pol_assess_set, bounds, **kwargs):
+def compute_policies_mh(df_original,multi_hard_info,pol_increment_mh,pol_assess_set, bounds, batched=False, **kwargs):
+    """Effect on pol_assess_set of incrementing each (var, hazard) column of the multi hazard data by pol_increment_mh.
+    batched: if True, evaluates the baseline and all the perturbed multi hazard data in a single call to compute_resiliences
+    Stages are recorded as in compute_policies (policy_mh instead of policy)"""
     
+    if batched:
+        progress_reporter("all policies (batched)")
+        
+        with stage("stack_scenarios", multi_hard_info, label=batched_label) as s:
+            #perturbations are applied on the (province, (var, hazard)) table
+            mh_stacked = s.output(stack_scenarios(multi_hard_info.unstack("hazard"), pol_increment_mh, columns=[eval(var) for var in pol_increment_mh.index]).stack("hazard"))
+            
+            #the socio economic data is the same in all scenarios
+            df_stacked = pd.concat([df_original]*(1+len(pol_increment_mh)), keys=[baseline_scenario]+pol_increment_mh.index.tolist(), names=["scenario"])
+        
+        with stage("policy_mh", df_stacked, label=batched_label) as s:
+            out = s.output(compute_resiliences(df_stacked, multihazard_data =mh_stacked)[pol_assess_set])
+        with stage("scenario_deltas", out, label=batched_label) as s:
+            delta = s.output(scenario_deltas(out))
+        progress_reporter("done.")       
+        return delta.stack("inputs").unstack("province").swaplevel('province', 'outputs', axis=1).sort_index(axis=1).dropna(how="all",axis=1)
+
     #initialize
     delta = pd.DataFrame(index=df_original.index, columns=pd.MultiIndex.from_product([pol_increment_mh.index,pol_assess_set], names=['inputs', 'outputs']))
     
     #baseline
-    fx = compute_resiliences(df_original, multihazard_data =multi_hard_info)[pol_assess_set]
+    with stage("policy_mh", df_original, label=baseline_scenario) as s:
+        fx = s.output(compute_resiliences(df_original, multihazard_data =multi_hard_info)[pol_assess_set])
         
-    for var in pol_increment_mh.index:
-        progress_reporter(var)
-
-        mh_=multi_hard_info.copy(deep=True).unstack("hazard")
+    #working copy, perturbed one (var, hazard) at a time
+    mh_=multi_hard_info.copy(deep=True)
+    hazards = mh_.index.get_level_values("hazard")
+    
+    for var in progress(pol_increment_mh.index, "policies"):
+        col, hazard = eval(var)
+        rows = hazards==hazard
 
         #increments
-        mh_[eval(var)]=mh_[eval(var)]+pol_increment_mh[var]
+        mh_[col]=np.where(rows, multi_hard_info[col]+pol_increment_mh[var], multi_hard_info[col])
 
         #new value
-        fxh= compute_resiliences(df_original, multihazard_data =mh_.stack("hazard"))[pol_assess_set]
+        with stage("policy_mh", df_original, label=var) as s:
+            fxh= s.output(compute_resiliences(df_original, multihazard_data =mh_)[pol_assess_set])
 
         #effect
         delta[var] = (fxh-fx)
+        
+        #restores
+        mh_[col]=multi_hard_info[col]
  
     
-    progress_reporter("done.")       
-    
     return delta.stack("inputs").unstack("province").swaplevel('province', 'outputs', axis=1).sort_index(axis=1).dropna(how="all",axis=1)
-        
+
+
+def stack_scenarios(df, pol_increment, columns=None):
+    """Stacks the baseline df and one perturbed copy per policy along a new "scenario" index level.
+    In the scenario named var, column var (or columns[i] for the i-th policy, if provided) is incremented by pol_increment[var]"""
+    
+    scenarios = [baseline_scenario]+pol_increment.index.tolist()
+    stacked = pd.concat([df]*len(scenarios), keys=scenarios, names=["scenario"])
+    
+    if columns is None:
+        columns = pol_increment.index.tolist()
+    
+    scenario_level = stacked.index.get_level_values("scenario")
+    for var, col in zip(pol_increment.index, columns):
+        stacked[col] = stacked[col].astype(float) #increments may not be integers
+        stacked.loc[scenario_level==var, col] += pol_increment[var]
+    
+    return stacked
+
+def scenario_deltas(out):
+    """Differences between each scenario and the baseline scenario in out (indexed by (scenario, province)).
+    Returns a dataframe indexed by province, with columns (inputs, outputs), as the loop in compute_policies does"""
+    
+    #baseline values copied on every scenario
+    fx = align_on_levels(out.xs(baseline_scenario, level="scenario"), out.index)
+    
+    delta = (out - fx.values).drop(baseline_scenario, level="scenario")
+    
+    delta = delta.unstack("scenario").swaplevel(axis=1)
+    delta.columns.names = ['inputs', 'outputs']
+    
+    return delta
+    
 def render_pol_cards(deltas,colors,policy_descriptions,pol_increment,unit,province_list, 
-outfolder="cards/"):
+outfolder="cards/", workers=None, **kwargs):
     """Rendeltas the policy cards
     deltas: dataframe indexed by (var). Column is multi-indexed: provinces x ["dWtot_currency","dKtot"]. The impact of marginally increasing var in province on dw and dK.
     policy_descriptions. Series index by variable. Explains what the policy is. eg "Decrease poverty to 0.1%" 
     colors: dataframe. Columns: ["dWtot_currency","dKtot"]. Rows: kwargs to pass to plt.barh for formatting the color bars.
     unit: dictionary such as {"multiplier":1000, "string" Thousands }. For the x label.
     province_list: provinces to plot. Should be in deltas.index.
+    workers: number of processes rendering cards (see render_cards)
+    kwargs: passed to render_cards (formats, dpi, merged). For example merged="all_cards.pdf", formats=["pdf", "png"] replaces merge_cardfiles and convert_pdf_to_png
     """
     
-    # print("HELLOOOOO")
-   
+    cards = []
     for p in province_list:
-        #Displays current province in the loop 
-        progress_reporter(p)    
-        
         #select current line in deltas, and scales it.
         toplot = unit["multiplier"]*deltas[p].dropna()  
         
         #assumes the policy is framed in terms of what increases welfare ("decrease poverty", not "increase poverty")
         pol_sign  = -np.sign(toplot.dWtot_currency)
-        toplot = toplot.mul(pol_sign,axis=0)
-        toplot = toplot[["dWtot_currency","dKtot"]].sort_values("dWtot_currency",ascending=False)       
-        
-        #number of policy experiments to render
-        n=toplot.shape[0]
-        
-        #new figure
-        fig, ax = plt.subplots(figsize=(3.5,n/2))
+        cards.append(policy_card(toplot.mul(pol_sign,axis=0), policy_labels(policy_descriptions, pol_sign, pol_increment), p, outfolder+file_name_formater(p)))
     
-        #actual plotting
-        ind=np.arange(n)
-        
-        rects1 = ax.barh(ind,toplot["dKtot"],height=height, **colors.ix["dKtot"]
-               )
-        rects2 = ax.barh(ind+height,  toplot["dWtot_currency"],height=height, **colors.ix["dWtot_currency"]
-                )
-
-        #0 line
-        plt.vlines(0, 0, n, colors="black")    
-        
-        for k in deltas.index:
-            policy_descriptions[k] = policy_descriptions[k].format(sign=("-" if pol_sign[k]<0 else "+"),dh=pol_increment[k])
-        
-        
-        # add some labels, title and axes ticks
-        ax.set_xlabel(unit["string"])
-        ax.set_yticks(ind+height)
-        ax.set_yticklabels(policy_descriptions[toplot.index]+"     "  )
-        plt.title(p);
-
-        # remove spines
-        # ax.spines['bottom'].set_color('none')
-        ax.spines['right'].set_color('none')
-
-        ax.spines['top'].set_color('none')
-        ax.spines['left'].set_color("none")
-
-        #removes ticks 
-        for tic in ax.xaxis.get_major_ticks() + ax.yaxis.get_major_ticks():
-            tic.tick1On = tic.tick2On = False
-        
-        ax.xaxis.set_ticklabels([])
-
-        #labels (numbers) on the bars
-        autolabel(ax,rects1,colors.ix["dKtot","edgecolor"],2,**tinyfont)
-        autolabel(ax,rects2,colors.ix["dWtot_currency","edgecolor"],2,**smallfont)
-
-        #annotated "legend"
-        ax.annotate("Effect on asset losses",  xy=(0,n-1+height/2),xycoords='data',ha="left",va="center",
-                      xytext=(20, -5), textcoords='offset points', 
-                        arrowprops=dict(arrowstyle="->",
-                                        connectionstyle="arc3,rad=-0.13",color=colors.edgecolor.dKtot
-                                        ), **smallfont)
-
-        ax.annotate("Effect on welfare losses",  xy=(0,n-height),xycoords='data',ha="left",va="center",
-                      xytext=(20, 3), textcoords='offset points', 
-                        arrowprops=dict(arrowstyle="->",
-                                        connectionstyle="arc3,rad=+0.13",color=colors.edgecolor.dWtot_currency
-                                        ), **smallfont)
-
-        
-        glob.os.makedirs(outfolder,exist_ok=True)
-        #exports to pdf
-        plt.savefig(outfolder+file_name_formater(p)+".pdf",
-                    bbox_inches="tight" #ensures the policy label are not cropped out
-                    )
+    render_cards(cards, colors, unit, workers=workers, **kwargs)
                     
 def render_pol_card_national(deltas,colors,policy_descriptions,pol_increment,unit, 
-outfolder="cards/"):
+outfolder="cards/", **kwargs):
     """Rendeltas the policy cards
     deltas: dataframe indexed by (var). Column is multi-indexed: provinces x ["dWtot_currency","dKtot"]. The impact of marginally increasing var in province on dw and dK.
     policy_descriptions. Series index by variable. Explains what the policy is. eg "Decrease poverty to 0.1%" 
     colors: dataframe. Columns: ["dWtot_currency","dKtot"]. Rows: kwargs to pass to plt.barh for formatting the color bars.
     unit: dictionary such as {"multiplier":1000, "string" Thousands }. For the x label.
     province_list: provinces to plot. Should be in deltas.index.
+    kwargs: passed to render_cards (formats, dpi)
     """
     
-    # print("HELLOOOOO")
-   
     #select current line in deltas, and scales it.
     toplot = unit["multiplier"]*deltas.dropna()  
     
     #assumes the policy is framed in terms of what increases welfare ("decrease poverty", not "increase poverty")
     pol_sign  = -np.sign(toplot.dWtot_currency)
-    toplot = toplot.mul(pol_sign,axis=0)
-    toplot = toplot[["dWtot_currency","dKtot"]].sort_values("dWtot_currency",ascending=False)       
-    
-    #number of policy experiments to render
-    n=toplot.shape[0]
+    card = policy_card(toplot.mul(pol_sign,axis=0), policy_labels(policy_descriptions, pol_sign, pol_increment), "Philippines", outfolder+"Philippines")
     
-    #new figure
-    fig, ax = plt.subplots(figsize=(3.5,n/2))
-
-    #actual plotting
-    ind=np.arange(n)
-    
-    rects1 = ax.barh(ind,toplot["dKtot"],height=height, **colors.ix["dKtot"]
-           )
-    rects2 = ax.barh(ind+height,  toplot["dWtot_currency"],height=height, **colors.ix["dWtot_currency"]
-            )
-
-    #0 line
-    plt.vlines(0, 0, n, colors="black")    
-    
-    for k in deltas.index:
-        policy_descriptions[k] = policy_descriptions[k].format(sign=("-" if pol_sign[k]<0 else "+"),dh=pol_increment[k])
-    
-    
-    # add some labels, title and axes ticks
-    ax.set_xlabel(unit["string"])
-    ax.set_yticks(ind+height)
-    ax.set_yticklabels(policy_descriptions[toplot.index]+"     "  )
-    plt.title("Philippines");
-
-    # remove spines
-    # ax.spines['bottom'].set_color('none')
-    ax.spines['right'].set_color('none')
-
-    ax.spines['top'].set_color('none')
-    ax.spines['left'].set_color("none")
-
-    #removes ticks 
-    for tic in ax.xaxis.get_major_ticks() + ax.yaxis.get_major_ticks():
-        tic.tick1On = tic.tick2On = False
-    
-    ax.xaxis.set_ticklabels([])
-
-    #labels (numbers) on the bars
-    autolabel(ax,rects1,colors.ix["dKtot","edgecolor"],2,**tinyfont)
-    autolabel(ax,rects2,colors.ix["dWtot_currency","edgecolor"],2,**smallfont)
-
-    #annotated "legend"
-    ax.annotate("Effect on asset losses",  xy=(0,n-1+height/2),xycoords='data',ha="left",va="center",
-                  xytext=(20, -5), textcoords='offset points', 
-                    arrowprops=dict(arrowstyle="->",
-                                    connectionstyle="arc3,rad=-0.13",color=colors.edgecolor.dKtot
-                                    ), **smallfont)
-
-    ax.annotate("Effect on welfare losses",  xy=(0,n-height),xycoords='data',ha="left",va="center",
-                  xytext=(20, 3), textcoords='offset points', 
-                    arrowprops=dict(arrowstyle="->",
-                                    connectionstyle="arc3,rad=+0.13",color=colors.edgecolor.dWtot_currency
-                                    ), **smallfont)
-
-    
-    glob.os.makedirs(outfolder,exist_ok=True)
-    #exports to pdf
-    plt.savefig(outfolder+"Philippines.pdf",
-                bbox_inches="tight" #ensures the policy label are not cropped out
-                )
+    render_cards([card], colors, unit, workers=1, **kwargs)
 
 def render_pol_cards_per_policy(deltas,colors,policy_descriptions,pol_increment,unit,policy_list, 
-outfolder="cards/"):
+outfolder="cards/", workers=None, **kwargs):
     """Rendeltas the policy cards
     deltas: dataframe indexed by (var). Column is multi-indexed: provinces x ["dWtot_currency","dKtot"]. The impact of marginally increasing var in province on dw and dK.
     policy_descriptions. Series index by variable. Explains what the policy is. eg "Decrease poverty to 0.1%" 
     colors: dataframe. Columns: ["dWtot_currency","dKtot"]. Rows: kwargs to pass to plt.barh for formatting the color bars.
     unit: dictionary such as {"multiplier":1000, "string" Thousands }. For the x label.
     policy_list: provinces to plot. Should be in deltas.index.
+    workers: number of processes rendering cards (see render_cards)
+    kwargs: passed to render_cards (formats, dpi, merged)
     """
     
-    # print("HELLOOOOO")
-   
+    cards = []
     for pol in policy_list:
-        #Displays current province in the loop 
-        progress_reporter(pol)    
-        
         #select current line in deltas, and scales it.
         toplot = unit["multiplier"]*deltas[pol].dropna()  
         
         #assumes the policy is framed in terms of what increases welfare ("decrease poverty", not "increase poverty")
         pol_sign  = -np.sign(toplot.iloc[0].dWtot_currency)
-        toplot = toplot.mul(pol_sign,axis=0)
-        toplot = toplot[["dWtot_currency","dKtot"]].sort_values("dWtot_currency",ascending=False)       
-        
-        #number of PROVINCES experiments to render
-        n=toplot.shape[0]
+        the_policy_description = policy_descriptions[pol].format(sign=("-" if pol_sign<0 else "+"),dh=pol_increment[pol])
         
-        #new figure
-        fig, ax = plt.subplots(figsize=(3.5,n/2.1))
+        #one bar per province
+        cards.append(policy_card(toplot.mul(pol_sign,axis=0), pd.Series(toplot.index, index=toplot.index), the_policy_description, outfolder+file_name_formater(pol)))
+    
+    render_cards(cards, colors, unit, workers=workers, height_per_bar=2.1, legend=True, annotate=False, **kwargs)
+
+def policy_labels(policy_descriptions, pol_sign, pol_increment):
+    """policy_descriptions formatted with the sign (pol_sign) and the size (pol_increment) of each policy, for the policies in pol_sign.index"""
+    return pd.Series({k: policy_descriptions[k].format(sign=("-" if pol_sign[k]<0 else "+"),dh=pol_increment[k]) for k in pol_sign.index})
+
+def policy_card(toplot, labels, title, path):
+    """Data of a card (see render_cards): bars sorted by decreasing effect on welfare losses
+    toplot: dataframe with columns dWtot_currency and dKtot, one line per bar. labels: label of each line of toplot
+    path: file of the card, without extension (see render_cards)"""
+    toplot = toplot[["dWtot_currency","dKtot"]].sort_values("dWtot_currency",ascending=False)       
+    return dict(dK=toplot["dKtot"].values, dW=toplot["dWtot_currency"].values, labels=(labels[toplot.index]+"     ").tolist(), title=title, path=path)
+
+
+def render_cards(cards, colors, unit, workers=None, formats=["pdf"], dpi=150, merged=None, height_per_bar=2, legend=False, annotate=True):
+    """Saves cards (dicts with dK, dW, labels, title and path, see policy_card), in a pool of processes.
+    Cards are drawn on a CardTemplate, built once per number of bars (and per process), and saved to all the outputs from that drawing.
+    workers: number of processes (defaults to the number of cores). With one worker, renders in this process.
+    formats: one file per card and format, path.pdf for pdf, and in a subfolder named after the format for the others (path/../png/name.png, as convert_pdf_to_png did).
+    dpi: resolution of the raster formats (png).
+    merged: path of a multipage pdf of all the cards, with one bookmark per card (its title). Cards are then rendered in this process, which writes the document.
+    height_per_bar, legend, annotate: see CardTemplate"""
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    style = dict(colors=colors, unit=unit, height_per_bar=height_per_bar, legend=legend, annotate=annotate)
+    output = dict(formats=formats, dpi=dpi)
+
+    if merged is not None:
+        os.makedirs(os.path.dirname(merged) or ".",exist_ok=True)
+        templates = dict()
+        with PdfPages(merged) as pdf:
+            for card in progress(cards, "cards"):
+                _draw_card(templates, style, output, card, pdf)
+        add_pdf_bookmarks(merged, [card["title"] for card in cards])
+        return
+
+    if workers==1 or len(cards)<=1:
+        templates = dict()
+        for card in progress(cards, "cards"):
+            _draw_card(templates, style, output, card)
+        return
+
+    with ProcessPoolExecutor(workers, initializer=_init_card_worker, initargs=(style, output)) as pool:
+        for _ in progress(pool.map(_render_card, cards, chunksize=max(1, len(cards)//(4*workers))), "cards", total=len(cards)):
+            pass
+
+
+class CardTemplate:
+    """Policy card with n pairs of bars (effect on asset losses and on welfare losses), styled once.
+    draw only updates the bars, the numbers on the bars, the labels and the title before saving.
+    Uses matplotlib.figure.Figure directly: the figure is not held by pyplot, and does not depend on its backend.
+    height_per_bar: the height of the figure is n/height_per_bar inches.
+    legend: adds a legend. annotate: adds arrows pointing at the top bars instead."""
+
+    def __init__(self, n, colors, unit, height_per_bar=2, legend=False, annotate=True):
+        self.n = n
+        self.fig = Figure(figsize=(3.5,n/height_per_bar))
+        ax = self.ax = self.fig.add_subplot(111)
     
-        #actual plotting
         ind=np.arange(n)
-        rects1 = ax.barh(ind,toplot["dKtot"],height=height, **colors.ix["dKtot"]
-               )
-        rects2 = ax.barh(ind+height,  toplot["dWtot_currency"],height=height, **colors.ix["dWtot_currency"]
-                )
-                
-        ax.legend(["Effect on asset losses", "Effect on welfare losses"],loc="best")
+        self.rects1 = ax.barh(ind,np.zeros(n),height=height, **colors.loc["dKtot"])
+        self.rects2 = ax.barh(ind+height,np.zeros(n),height=height, **colors.loc["dWtot_currency"])
+        
+        if legend:
+            ax.legend(["Effect on asset losses", "Effect on welfare losses"],loc="best")
 
         #0 line
-        plt.vlines(0, 0, n, colors="black")    
-        
-        the_policy_description = policy_descriptions[pol].format(sign=("-" if pol_sign<0 else "+"),dh=pol_increment[pol])
+        ax.vlines(0, 0, n, colors="black")    
         
-        # add some labels, title and axes ticks
+        # add some labels and axes ticks
         ax.set_xlabel(unit["string"])
         ax.set_yticks(ind+height)
-        ax.set_yticklabels(toplot.index+"     "  )
-        plt.title(policy_descriptions[pol]);
 
         # remove spines
-        # ax.spines['bottom'].set_color('none')
         ax.spines['right'].set_color('none')
-
         ax.spines['top'].set_color('none')
         ax.spines['left'].set_color("none")
 
-        #removes ticks 
-        for tic in ax.xaxis.get_major_ticks() + ax.yaxis.get_major_ticks():
-            tic.tick1On = tic.tick2On = False
-        
-        ax.xaxis.set_ticklabels([])
+        #removes ticks and the numbers on the x axis
+        ax.tick_params(which="both", bottom=False, top=False, left=False, right=False)
+        ax.xaxis.set_major_formatter(NullFormatter())
 
         #labels (numbers) on the bars
-        autolabel(ax,rects1,colors.ix["dKtot","edgecolor"],2,**tinyfont)
-        autolabel(ax,rects2,colors.ix["dWtot_currency","edgecolor"],2,**smallfont)
+        self.texts1 = [ax.text(0, r.get_y()+0.4*height, "", va='center', color=colors.loc["dKtot","edgecolor"], **tinyfont) for r in self.rects1]
+        self.texts2 = [ax.text(0, r.get_y()+0.4*height, "", va='center', color=colors.loc["dWtot_currency","edgecolor"], **smallfont) for r in self.rects2]
 
         #annotated "legend"
-        # ax.annotate("Effect on asset losses",  xy=(0,n-1+height/2),xycoords='data',ha="left",va="center",
-                      # xytext=(20, -5), textcoords='offset points', 
-                        # arrowprops=dict(arrowstyle="->",
-                                        # connectionstyle="arc3,rad=-0.13",color=colors.edgecolor.dKtot
-                                        # ), **smallfont)
-
-        # ax.annotate("Effect on welfare losses",  xy=(0,n-height),xycoords='data',ha="left",va="center",
-                      # xytext=(20, 3), textcoords='offset points', 
-                        # arrowprops=dict(arrowstyle="->",
-                                        # connectionstyle="arc3,rad=+0.13",color=colors.edgecolor.dWtot_currency
-                                        # ), **smallfont)
-
-
-        glob.os.makedirs(outfolder,exist_ok=True)
-        #exports to pdf
-        plt.savefig(outfolder+file_name_formater(pol)+".pdf",
+        if annotate:
+            ax.annotate("Effect on asset losses",  xy=(0,n-1+height/2),xycoords='data',ha="left",va="center",
+                          xytext=(20, -5), textcoords='offset points', 
+                            arrowprops=dict(arrowstyle="->",
+                                            connectionstyle="arc3,rad=-0.13",color=colors.edgecolor.dKtot
+                                            ), **smallfont)
+
+            ax.annotate("Effect on welfare losses",  xy=(0,n-height),xycoords='data',ha="left",va="center",
+                          xytext=(20, 3), textcoords='offset points', 
+                            arrowprops=dict(arrowstyle="->",
+                                            connectionstyle="arc3,rad=+0.13",color=colors.edgecolor.dWtot_currency
+                                            ), **smallfont)
+
+    def draw(self, dK, dW, labels, title):
+        """Updates the card with the values of the bars (dK, dW), their labels and the title"""
+        for rects, texts, values in ((self.rects1, self.texts1, dK), (self.rects2, self.texts2, dW)):
+            for rect, text, value in zip(rects, texts, values):
+                rect.set_width(value)
+                text.set_x(value)
+                text.set_text(bar_label(value, 2))
+                text.set_horizontalalignment("right" if value<0 else "left")
+        
+        self.ax.set_yticklabels(labels)
+        self.ax.set_title(title)
+
+        #the x axis follows the bars, the y axis only depends on n
+        self.ax.relim()
+        self.ax.autoscale_view(scaley=False)
+        return self.fig
+
+    def save(self, path, dpi=None, pdf=None):
+        """Saves the card to path (its format is that of the extension), or as a new page of pdf (a PdfPages) if path is None"""
+        if path is None:
+            pdf.savefig(self.fig, bbox_inches="tight")
+            return
+        os.makedirs(os.path.dirname(path) or ".",exist_ok=True)
+        self.fig.savefig(path, dpi=dpi,
                     bbox_inches="tight" #ensures the policy label are not cropped out
                     )
-            
+
+def card_file(path, fmt):
+    """File of the card saved at path (without extension) in format fmt (see render_cards)"""
+    if fmt=="pdf":
+        return path+".pdf"
+    return os.path.join(os.path.dirname(path), fmt, os.path.basename(path)+"."+fmt)
+
+def _draw_card(templates, style, output, card, pdf=None):
+    """Draws card on the template for its number of bars (built if not in templates), and saves it in each format of output (and in pdf if provided)"""
+    n = len(card["dK"])
+    if n not in templates:
+        templates[n] = CardTemplate(n, **style)
+    template = templates[n]
+    template.draw(card["dK"], card["dW"], card["labels"], card["title"])
+    for fmt in output["formats"]:
+        template.save(card_file(card["path"], fmt), output["dpi"])
+    if pdf is not None:
+        template.save(None, pdf=pdf)
+
+#state of each card rendering process, set once by _init_card_worker
+_card_worker = dict()
+
+def _init_card_worker(style, output):
+    matplotlib.use("Agg")
+    _card_worker.update(style=style, output=output, templates=dict())
+
+def _render_card(card):
+    _draw_card(_card_worker["templates"], _card_worker["style"], _card_worker["output"], card)
+    return card["path"]
+
+
+def add_pdf_bookmarks(path, titles):
+    """Adds a bookmark to each page of the pdf file path (as written by matplotlib): titles[i] for the i-th page.
+    The outline and the new catalog are appended to the file as an incremental update (the pages are not rewritten).
+    The bookmarks are read back once written (see pdf_bookmarks): if they do not match, the file is restored and a ValueError raised."""
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    #last trailer, catalog and page tree
+    trailer, start = _pdf_trailer(data)
+    size = int(re.search(rb"/Size (\d+)", trailer).group(1))
+    root = int(re.search(rb"/Root (\d+) 0 R", trailer).group(1))
+    info = re.search(rb"/Info (\d+) 0 R", trailer)
+    catalog = _pdf_dict(data, root, b"Catalog")
+    pages = _pdf_pages(data, int(re.search(rb"/Pages (\d+) 0 R", catalog).group(1)))
+
+    #outline object, then one object per bookmark
+    n = min(len(titles), len(pages))
+    outline = size
+    items = list(range(size+1, size+1+n))
+
+    objects = {outline: "<< /Type /Outlines /First {} 0 R /Last {} 0 R /Count {} >>".format(items[0], items[-1], n) if n else "<< /Type /Outlines /Count 0 >>"}
+    for i, (item, page) in enumerate(zip(items, pages)):
+        links = "" if i==0 else " /Prev {} 0 R".format(items[i-1])
+        links += "" if i==n-1 else " /Next {} 0 R".format(items[i+1])
+        objects[item] = "<< /Title <FEFF{}> /Parent {} 0 R /Dest [ {} 0 R /Fit ]{} >>".format(str(titles[i]).encode("utf-16-be").hex().upper(), outline, page, links)
+
+    #(an outline already there is replaced)
+    catalog = re.sub(rb"/Outlines\s+\d+\s+\d+\s+R|/PageMode\s*/\w+", b"", catalog)
+    objects[root] = "<<{} /Outlines {} 0 R /PageMode /UseOutlines >>".format(catalog.decode("latin-1").rstrip(), outline)
+
+    #update section
+    update = b"\n"
+    offsets = dict()
+    for i in sorted(objects):
+        offsets[i] = len(data)+len(update)
+        update += "{} 0 obj\n{}\nendobj\n".format(i, objects[i]).encode("latin-1")
+
+    xref = len(data)+len(update)
+    update += b"xref\n"
+    for first, stop in ((root, root+1), (size, size+1+n)):
+        update += "{} {}\n".format(first, stop-first).encode()
+        for i in range(first, stop):
+            update += "{:010d} 00000 n \n".format(offsets[i]).encode()
+
+    update += "trailer\n<< /Size {} /Root {} 0 R{} /Prev {} >>\nstartxref\n{}\n%%EOF\n".format(
+        size+1+n, root, "" if info is None else " /Info {} 0 R".format(info.group(1).decode()), start, xref).encode()
+
+    with open(path, "ab") as f:
+        f.write(update)
+
+    #round trip
+    written = pdf_bookmarks(path)
+    expected = [str(t) for t in titles[:n]]
+    if written!=expected:
+        with open(path, "r+b") as f:
+            f.truncate(len(data))
+        raise ValueError("bookmarks of {} do not read back: {} instead of {}".format(path, written, expected))
+
+def pdf_bookmarks(path):
+    """Titles of the top level bookmarks of the pdf file path (as written by add_pdf_bookmarks)"""
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    catalog = _pdf_dict(data, int(re.search(rb"/Root (\d+) 0 R", _pdf_trailer(data)[0]).group(1)), b"Catalog")
+    item = re.search(rb"/Outlines (\d+) 0 R", catalog)
+    if item is None:
+        return []
+    item = re.search(rb"/First (\d+) 0 R", _pdf_dict(data, int(item.group(1))))
+
+    titles = []
+    while item is not None:
+        bookmark = _pdf_dict(data, int(item.group(1)))
+        titles.append(bytes.fromhex(re.search(rb"/Title <FEFF([0-9A-F]*)>", bookmark).group(1).decode()).decode("utf-16-be"))
+        item = re.search(rb"/Next (\d+) 0 R", bookmark)
+    return titles
+
+def _pdf_trailer(data):
+    """Dictionary of the last trailer of pdf data (without << >>), and the offset of its xref table"""
+    trailer = re.search(rb"trailer\s*<<(.*?)>>\s*startxref\s*(\d+)\s*%%EOF\s*$", data, re.S)
+    if trailer is None:
+        raise ValueError("no trailer at the end of the pdf (cross-reference streams are not supported)")
+    return trailer.group(1), int(trailer.group(2))
+
+def _pdf_dict(data, obj, type=None):
+    """Dictionary of object obj in pdf data (without << >>), from its last definition (incremental updates append new ones).
+    type: if provided, the /Type the dictionary must have. Raises a ValueError if the object is not found or has another type."""
+    found = re.findall(rb"(?<!\d)%d 0 obj\s*<<(.*?)>>\s*endobj" % obj, data, re.S)
+    if not found:
+        raise ValueError("pdf object {} not found (compressed object streams are not supported)".format(obj))
+    if type is not None and re.search(rb"/Type\s*/%s(?![\w])" % type, found[-1]) is None:
+        raise ValueError("pdf object {} is not a /Type /{}".format(obj, type.decode()))
+    return found[-1]
+
+def _pdf_pages(data, pages_id):
+    """Objects of the pages of the page tree pages_id, which must be flat (as matplotlib writes it)"""
+    tree = _pdf_dict(data, pages_id, b"Pages")
+    pages = [int(k) for k in re.findall(rb"(\d+) 0 R", re.search(rb"/Kids\s*\[(.*?)\]", tree, re.S).group(1))]
+    if len(pages)!=int(re.search(rb"/Count (\d+)", tree).group(1)):
+        raise ValueError("nested pdf page trees are not supported")
+    return pages
+
+def bar_label(value, sigdigits):
+    """Number written on a bar: value with sigdigits significant digits (see fancy_round), without trailing zeros, padded on the side of the bar"""
+    
+    #truncates the value to sigdigits digits after the coma.
+    stri=str(fancy_round(value,sigdigits))
+    
+    #remove trailing zeros
+    if "." in stri:
+        while stri.endswith("0"):
+            stri=stri[:-1]        
+    
+    #remove trailing dot
+    if stri.endswith("."):
+        stri=stri[:-1]        
+    
+    if stri=="-0":
+        stri="0"
+    
+    #space before or after (pad)
+    if value<0:
+        stri = stri+' '
+    else:
+        stri = ' '+stri
+
+    return stri
+
 def autolabel(ax,rects,color, sigdigits,  **kwargs):
     """attach labels to an existing horizontal bar plot. Passes kwargs to the text (font, color, etc)"""
     
@@ -348,32 +539,8 @@ def autolabel(ax,rects,color, sigdigits,  **kwargs):
         #figures out if it is a negative or positive value
         value = x if x<0 else w
 
-        ####
-        # FORMATS LABEL
-        
-        #truncates the value to sigdigits digits after the coma.
-        stri=str(fancy_round(value,sigdigits))
-        
-        #remove trailing zeros
-        if "." in stri:
-            while stri.endswith("0"):
-                stri=stri[:-1]        
-        
-        #remove trailing dot
-        if stri.endswith("."):
-            stri=stri[:-1]        
-        
-        if stri=="-0":
-            stri="0"
-        
-        #space before or after (pad)
-        if value<0:
-            stri = stri+' '
-        else:
-            stri = ' '+stri
-
         #actual print    
-        ax.text(value, y+0.4*h, stri, ha="right" if x<0 else 'left', va='center', color=color , **kwargs)
+        ax.text(value, y+0.4*h, bar_label(value, sigdigits), ha="right" if x<0 else 'left', va='center', color=color , **kwargs)
 
 def check_bounds(df, bounds):
     clip = df.clip(lower=bounds.inf.dropna(),upper=bounds.sup.dropna(),axis=1).fillna(df)
@@ -408,7 +575,8 @@ def file_name_formater(string):
        
 
 def merge_cardfiles(list,outputname):
-    """Merges individual policy card pdf to a single multi page pdf with all the cards. Requires ghostscipt."""
+    """Merges individual policy card pdf to a single multi page pdf with all the cards. Requires ghostscipt.
+    render_pol_cards(..., merged=outputname) writes the same document (with bookmarks) while rendering the cards, without ghostscript."""
     #implements http://stackoverflow.com/questions/7102090/combining-pdf-files-with-ghostscript-how-to-include-original-file-names
 
     #builds the command for ghostscript
@@ -437,7 +605,8 @@ def merge_cardfiles(list,outputname):
 
 def convert_pdf_to_png(folder):
     """Convert individual pdf cards to PNG. Requires imagemagick. 
-    Moves the resulting png to a subolfer""" 
+    Moves the resulting png to a subolfer
+    render_pol_cards(..., formats=["pdf", "png"]) writes the same files while rendering the cards, without imagemagick.""" 
     
     folder = glob.os.path.dirname(folder)
         
@@ -1,7 +1,187 @@
 import sys
-from IPython.display import clear_output
+import time
+import logging
+from xml.sax.saxutils import escape
+
+#backend used when none is given (see set_progress_backend), chosen on first use if None
+_backend = None
+
+def progress(iterable, label=None, total=None, backend=None, interval=0.5):
+    """Yields the items of iterable and reports the progress of the loop, at most once every interval seconds (and when it ends).
+    Reports include the current item, the count, the rate and (if total is known) the estimated time left.
+    backend: where reports go (see set_progress_backend for the default).
+
+    for var in progress(pol_increment.index, "policies"):
+        ..."""
+
+    if total is None and hasattr(iterable, "__len__"):
+        total = len(iterable)
+
+    p = Progress(label, total, backend, interval)
+    for item in iterable:
+        p.update(item)
+        yield item
+        p.count += 1
+    p.done()
+
+
+class Progress:
+    """Throttled progress of a loop. update is cheap between reports: it only reads the clock."""
+
+    def __init__(self, label=None, total=None, backend=None, interval=0.5):
+        self.label = label
+        self.total = total
+        self.backend = get_progress_backend() if backend is None else backend
+        self.interval = interval
+        self.count = 0
+        self.item = None
+        self.start = time.perf_counter()
+        self.next_report = self.start
+
+    def update(self, item=None):
+        """Sets the current item (count is the number of items done), and reports if the last report is older than interval"""
+        self.item = item
+        now = time.perf_counter()
+        if now>=self.next_report:
+            self.next_report = now+self.interval
+            self.backend.report(self.state(now))
+
+    def done(self):
+        """Reports the end of the loop"""
+        self.item = None
+        self.backend.report(self.state(time.perf_counter(), done=True))
+
+    def state(self, now, done=False):
+        """Dict with label, item, count, total, elapsed (seconds), rate (items per second), eta (seconds left, None if unknown) and done"""
+        elapsed = now-self.start
+        rate = self.count/elapsed if elapsed>0 else None
+        eta = None
+        if rate and self.total is not None:
+            eta = (self.total-self.count)/rate
+        return dict(label=self.label, item=self.item, count=self.count, total=self.total, elapsed=elapsed, rate=rate, eta=eta, done=done)
+
+
+def format_progress(state):
+    """One line describing a progress state (see Progress.state)"""
+    line = "" if state["label"] is None else "{}: ".format(state["label"])
+    line += "{}".format(state["count"]) if state["total"] is None else "{}/{}".format(state["count"], state["total"])
+    if state["done"]:
+        return line+" done in {:.1f}s".format(state["elapsed"])
+    if state["item"] is not None:
+        line += " (now on {})".format(state["item"])
+    if state["rate"]:
+        line += ", {:.3g}/s".format(state["rate"])
+    if state["eta"] is not None:
+        line += ", {:.0f}s left".format(state["eta"])
+    return line
+
+
+class NullBackend:
+    """Drops all reports"""
+
+    def report(self, state):
+        pass
+
+    def message(self, text):
+        pass
+
+    def link(self, path, text):
+        pass
+
+class TerminalBackend:
+    """Rewrites a single line of stream (stderr by default). If stream is not a terminal (a file, a pipe, the log of a batch job), writes one line per report instead"""
+
+    def __init__(self, stream=None):
+        self.stream = sys.stderr if stream is None else stream
+        isatty = getattr(self.stream, "isatty", None)
+        self.rewrite = isatty is not None and isatty()
+
+    def report(self, state):
+        if self.rewrite:
+            self.stream.write("\r\033[K"+format_progress(state)+("\n" if state["done"] else ""))
+        else:
+            self.stream.write(format_progress(state)+"\n")
+        self.stream.flush()
+
+    def message(self, text):
+        self.stream.write(("\r\033[K" if self.rewrite else "")+str(text)+"\n")
+        self.stream.flush()
+
+    def link(self, path, text):
+        self.message("{}: {}".format(text, path))
+
+class LoggingBackend:
+    """Logs reports with logger (the "progress" logger by default) at level"""
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logging.getLogger("progress") if logger is None else logger
+        self.level = level
+
+    def report(self, state):
+        self.logger.log(self.level, format_progress(state))
+
+    def message(self, text):
+        self.logger.log(self.level, text)
+
+    def link(self, path, text):
+        self.message("{}: {}".format(text, path))
+
+class NotebookBackend:
+    """Updates a single output line of the current notebook cell per loop (needs IPython)"""
+
+    def __init__(self):
+        from IPython.display import display  #only needed in notebooks
+        self.display = display
+        self.handle = None
+
+    def report(self, state):
+        text = {"text/plain": format_progress(state)}
+        if self.handle is None:
+            self.handle = self.display(text, raw=True, display_id=True)
+        else:
+            self.handle.update(text, raw=True)
+        if state["done"]:
+            self.handle = None
+
+    def message(self, text):
+        self.display({"text/plain": str(text)}, raw=True)
+
+    def link(self, path, text):
+        #a link opening in a new tab
+        self.display({"text/html": "<a target='_blank' href='{}'>{}</a>".format(escape(path, {"'": "&#x27;"}), escape(text)),
+                      "text/plain": "{}: {}".format(text, path)}, raw=True)
+
+
+def set_progress_backend(backend):
+    """Sets the backend of progress and progress_reporter when none is given: an object with methods report(state), message(text) and link(path, text) (a file written),
+    for example NullBackend(), TerminalBackend(), LoggingBackend() or NotebookBackend(). None goes back to the automatic choice."""
+    global _backend
+    _backend = backend
+
+def get_progress_backend():
+    """The backend set by set_progress_backend. Otherwise, a NotebookBackend in a notebook, a LoggingBackend if logging is configured
+    to show the info messages of the "progress" logger, a TerminalBackend on stderr elsewhere (one line per report if stderr is not a terminal, as in batch jobs),
+    a NullBackend if there is no stderr"""
+    global _backend
+    if _backend is None:
+        logger = logging.getLogger("progress")
+        if in_notebook():
+            _backend = NotebookBackend()
+        elif logger.hasHandlers() and logger.isEnabledFor(logging.INFO):
+            _backend = LoggingBackend(logger)
+        elif sys.stderr is not None:
+            _backend = TerminalBackend()
+        else:
+            _backend = NullBackend()
+    return _backend
+
+def in_notebook():
+    """True in a Jupyter kernel (IPython is only looked up if it has already been imported)"""
+    ipython = sys.modules.get("IPython")
+    shell = ipython.get_ipython() if ipython is not None else None
+    return shell is not None and "IPKernelApp" in shell.config
+
+
 def progress_reporter(c):
-    #report progress
-    clear_output()
-    print("Currently working on: ", c)
-    sys.stdout.flush()    
\ No newline at end of file
+    #report progress (one message, see progress for loops)
+    get_progress_backend().message(c)
@@ -0,0 +1,335 @@
+import numpy as np
+import pandas as pd
+
+from res_ind_lib import *
+from res_ind_kernel import KERNEL_INPUTS, KERNEL_OUTPUTS, RISK_INPUTS, MODEL_OUTPUTS
+
+#model inputs read on each event (line of the broadcast dataframe)
+ROW_INPUTS = KERNEL_INPUTS+["gdp_pc_pp"]
+
+#model inputs read at the province level, after aggregation of the events
+PROVINCE_INPUTS = RISK_INPUTS
+
+#inputs differentiated by default (protectionref only selects the events above protection: its derivative is 0)
+MODEL_INPUTS = ROW_INPUTS+[c for c in PROVINCE_INPUTS if c not in ROW_INPUTS]
+
+
+#############################################################################
+#######################      AUTOMATIC DIFFERENTIATION  #####################
+#############################################################################
+
+class Differentiable:
+    """Arithmetic operators shared by Dual and Adjoint. Each operation is defined by its value and its partial derivatives (see elementwise)."""
+
+    #makes numpy arrays defer to Differentiable in mixed operations
+    __array_priority__ = 1000
+
+    def __add__(self, other):
+        return elementwise(value(self)+value(other), (self, other), (1, 1))
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return elementwise(value(self)-value(other), (self, other), (1, -1))
+
+    def __rsub__(self, other):
+        return elementwise(value(other)-value(self), (self, other), (-1, 1))
+
+    def __mul__(self, other):
+        return elementwise(value(self)*value(other), (self, other), (value(other), value(self)))
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        q = value(self)/value(other)
+        return elementwise(q, (self, other), (1/value(other), -q/value(other)))
+
+    def __rtruediv__(self, other):
+        q = value(other)/value(self)
+        return elementwise(q, (self, other), (-q/value(self), 1/value(self)))
+
+    def __neg__(self):
+        return elementwise(-value(self), (self,), (-1,))
+
+
+class Dual(Differentiable):
+    """Forward-mode dual number over arrays.
+    value has shape (n,). tangent has shape (k,n): one line per direction of differentiation."""
+
+    def __init__(self, value, tangent):
+        self.value = value
+        self.tangent = tangent
+
+    def copy(self):
+        return Dual(self.value.copy(), self.tangent.copy())
+
+
+class Adjoint(Differentiable):
+    """Reverse-mode variable over arrays. 
+    Remembers the variables it was computed from, with the function that maps its gradient to theirs (see backward)."""
+
+    def __init__(self, value, parents=()):
+        self.value = value
+        self.parents = parents
+        self.grad = None
+
+    def copy(self):
+        return Adjoint(self.value.copy(), [(self, lambda g: g)])
+
+
+def value(x):
+    """Value of a Dual or an Adjoint, or x itself"""
+    return x.value if isinstance(x, Differentiable) else x
+
+def elementwise(val, args, partials):
+    """Result of an elementwise operation on args, given its value and its partial derivative with respect to each arg"""
+
+    tangent = None
+    parents = []
+    for a, p in zip(args, partials):
+        if isinstance(a, Dual):
+            tangent = p*a.tangent if tangent is None else tangent + p*a.tangent
+        elif isinstance(a, Adjoint):
+            parents.append((a, lambda g, p=p: g*p))
+
+    if parents:
+        return Adjoint(val, parents)
+    if tangent is None:
+        return val
+    return Dual(val, tangent)
+
+
+def backward(y, seed):
+    """Propagates the gradient seed of y back to all the variables y was computed from. Gradients are stored in their grad attribute."""
+
+    #topological order of the variables y depends on
+    order = []
+    seen = set()
+    stack = [(y, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if children_done:
+            order.append(node)
+            continue
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        stack.append((node, True))
+        stack.extend((p, False) for p, _ in node.parents if id(p) not in seen)
+
+    #from y to the inputs
+    grads = {id(y): seed}
+    for node in reversed(order):
+        g = grads.pop(id(node), None)
+        if g is None:
+            continue
+        node.grad = g
+        for p, vjp in node.parents:
+            contribution = vjp(g)
+            grads[id(p)] = contribution if id(p) not in grads else grads[id(p)]+contribution
+
+
+def welf_loss_partials(c, dc, elast):
+    """Welfare loss (see res_ind_lib.welf_loss) and its partial derivatives with respect to c, dc and elast.
+    Like the loss, the derivatives are computed from the relative loss dc/c, without differences of close welfare levels."""
+
+    c, dc, elast = np.broadcast_arrays(np.asarray(c, dtype=float), np.asarray(dc, dtype=float), np.asarray(elast, dtype=float))
+    loss = welf_loss(c, dc, elast)
+
+    #x=log(1-dc/c), t=(1-elast)*x
+    x = np.log1p(-dc/c)
+    e1 = 1-elast
+    t = e1*x
+    c_e = c**-elast
+
+    dl_dc = -c_e*np.expm1(-elast*x)
+    dl_ddc = c_e*np.exp(-elast*x)
+    with np.errstate(divide="ignore", invalid="ignore"): #rows with elasticity 1 are patched below
+        dl_de = -np.log(c)*loss + c**e1*(t*np.exp(t)-np.expm1(t))/e1**2
+
+    #limit for log utility
+    dl_de = np.where(elast==1, x*np.log(c)+x**2/2, dl_de)
+
+    return loss, dl_dc, dl_ddc, dl_de
+
+def welf_loss_ad(c, dc, elast):
+    """Welfare loss (see res_ind_lib.welf_loss), differentiable with respect to c, dc and elast"""
+    loss, dl_dc, dl_ddc, dl_de = welf_loss_partials(value(c), value(dc), value(elast))
+    return elementwise(loss, (c, dc, elast), (dl_dc, dl_ddc, dl_de))
+
+def welf_prime_ad(c, elast):
+    """Marginal welfare (see res_ind_lib.welf_prime), differentiable with respect to c and elast"""
+    c_val, e_val = value(c), value(elast)
+    wprime = welf_prime(c_val, e_val)
+    return elementwise(wprime, (c, elast), (-e_val*wprime/c_val, -np.log(c_val)*wprime))
+
+
+#############################################################################
+#######################      EVENTS                     #####################
+#############################################################################
+
+def gather(x, rows, scale=None):
+    """Copies x (one value per line of a source table) on events. rows: line of the source table of each event"""
+    if isinstance(x, Dual):
+        out = Dual(x.value[rows], x.tangent[:,rows])
+    elif isinstance(x, Adjoint):
+        n = len(x.value)
+        out = Adjoint(x.value[rows], [(x, lambda g: np.bincount(rows, g, minlength=n))])
+    else:
+        out = np.asarray(x, dtype=float)[rows]
+    if scale is not None:
+        out = out*scale
+    return out
+
+def aggregate(x, plan):
+    """Averages x over return periods and sums over hazards, as average_over_rp and sum_over_hazard do"""
+    A = plan.aggregation
+    if isinstance(x, Dual):
+        out = Dual(A.dot(x.value), A.dot(x.tangent.T).T)
+        out.value[plan.no_events] = np.nan
+        out.tangent[:,plan.no_events] = np.nan
+    elif isinstance(x, Adjoint):
+        out = Adjoint(A.dot(x.value), [(x, lambda g: A.T.dot(g))])
+        out.value[plan.no_events] = np.nan
+    else:
+        out = plan.aggregate(x)
+    return out
+
+
+def evaluate_events(plan, x, x_mh=None):
+    """Runs the model from the inputs x (dict of columns, one value per line of plan.index) and x_mh (dict of columns of the multi hazard data).
+    Inputs can be arrays, Dual or Adjoint. Returns a dict of all inputs and outputs at the province level."""
+
+    #inputs of each event
+    rows = dict()
+    for c in ROW_INPUTS:
+        if c in plan.mh_columns:
+            rows[c] = gather(x_mh[c], plan.hazard_row)
+        else:
+            rows[c] = gather(x[c], plan.province)
+        if c in ["fap","far"] and plan.ratio is not None:
+            rows[c] = rows[c]*plan.ratio
+
+    #dk_{hazard, return} and dW_{hazard, return}
+    dkdwhr = dK_dW_equations(rows, loss=welf_loss_ad)
+
+    #sums over hazards and return periods
+    out = dict(x)
+    for c in dkdwhr:
+        out[c] = aggregate(dkdwhr[c], plan)
+
+    return calc_risk_and_resilience_from_k_w(out, prime=welf_prime_ad)
+
+
+#############################################################################
+#######################      JACOBIAN                   #####################
+#############################################################################
+
+def compute_resiliences_with_jacobian(df_in, fa_ratios=None, multihazard_data =None, inputs=None, mh_inputs=None, integration="bins"):
+    """Computes all outputs as compute_resiliences does, and their derivatives with respect to inputs in a single evaluation (forward-mode automatic differentiation).
+    inputs: columns of df_in to differentiate with respect to. Defaults to all the model inputs in df_in.
+    mh_inputs: (var, hazard) columns of the multi hazard data to differentiate with respect to. Defaults to all of them.
+    integration: as in compute_resiliences.
+    Returns (df, jacobian). jacobian is indexed by inputs ((var, hazard) inputs are labelled as in policy_multihazard_description.csv), with columns (province, outputs), like the output of policy_assessment.compute_policies.
+    For small increments, compute_policies(df_in, pol_increment, ...) is close to jacobian.mul(pol_increment, axis=0).
+    The derivative with respect to protection does not account for the events that switch above or below the protection level."""
+
+    if inputs is None:
+        inputs = [c for c in MODEL_INPUTS if c in df_in.columns]
+
+    if multihazard_data is None:
+        mh_inputs = []
+    elif mh_inputs is None:
+        mh_inputs = [(c, h) for c in multihazard_data.columns for h in multihazard_data.index.get_level_values("hazard").unique()]
+
+    plan = EventPlan(df_in, fa_ratios, multihazard_data, integration)
+    k = len(inputs)+len(mh_inputs)
+
+    #seeds one direction of differentiation per input
+    x = {c: df_in[c].values.astype(float) for c in MODEL_INPUTS if c in df_in.columns}
+    for j, c in enumerate(inputs):
+        tangent = np.zeros((k, len(df_in)))
+        tangent[j] = 1
+        x[c] = Dual(x[c], tangent)
+
+    x_mh = dict()
+    if multihazard_data is not None:
+        hazards = multihazard_data.index.get_level_values("hazard")
+        for c in multihazard_data.columns:
+            tangent = np.zeros((k, len(multihazard_data)))
+            for j, (var, h) in enumerate(mh_inputs):
+                if var==c:
+                    tangent[len(inputs)+j, hazards==h] = 1
+            x_mh[c] = Dual(multihazard_data[c].values.astype(float), tangent)
+
+    with np.errstate(divide="ignore", invalid="ignore"): #provinces without losses have no resilience, as with pandas
+        out = evaluate_events(plan, x, x_mh)
+
+    #outputs
+    df = df_in.copy()
+    for c in MODEL_OUTPUTS:
+        df[c] = value(out[c])
+
+    #derivatives
+    labels = inputs+[str(v) for v in mh_inputs]
+    jacobian = pd.concat(
+        [pd.DataFrame(_tangent(out[c], k, len(df_in)), index=labels, columns=df_in.index) for c in MODEL_OUTPUTS],
+        axis=1, keys=MODEL_OUTPUTS, names=["outputs"]).swaplevel(0, 1, axis=1).sort_index(axis=1)
+    jacobian.index.name = "inputs"
+
+    return df, jacobian
+
+def _tangent(x, k, n):
+    """Tangent of x, zeros if x does not depend on the inputs"""
+    if isinstance(x, Dual):
+        return x.tangent
+    return np.zeros((k, n))
+
+
+#############################################################################
+#######################      ADJOINT                    #####################
+#############################################################################
+
+def compute_resiliences_adjoint(df_in, fa_ratios=None, multihazard_data =None, objective="dWtot_currency", weights=None, integration="bins"):
+    """Gradient of a scalar objective, the sum over provinces of weights*objective (an output of compute_resiliences), 
+    with respect to every input in every province, in a single backward pass (reverse-mode automatic differentiation).
+    Provinces where the objective is missing are left out of the sum. integration: as in compute_resiliences.
+    Returns (df, gradient, gradient_mh). df is the output of compute_resiliences. 
+    gradient has the index of df_in and one column per model input. gradient_mh has the index and columns of multihazard_data (None without multi hazard data).
+    For small increments, the effect of a policy on the objective in each province (as computed by compute_policies or compute_policies_mh) is close to gradient[var]*pol_increment[var], or gradient_mh[var].unstack("hazard")[hazard]*pol_increment_mh[(var, hazard)].
+    The derivative with respect to protection does not account for the events that switch above or below the protection level."""
+
+    plan = EventPlan(df_in, fa_ratios, multihazard_data, integration)
+
+    inputs = [c for c in MODEL_INPUTS if c in df_in.columns]
+    x = {c: Adjoint(df_in[c].values.astype(float)) for c in inputs}
+
+    x_mh = dict()
+    if multihazard_data is not None:
+        x_mh = {c: Adjoint(multihazard_data[c].values.astype(float)) for c in multihazard_data.columns}
+
+    with np.errstate(divide="ignore", invalid="ignore"): #provinces without losses have no resilience, as with pandas
+        out = evaluate_events(plan, x, x_mh)
+
+        #d(objective)/d(output)
+        seed = np.ones(len(df_in)) if weights is None else np.asarray(weights, dtype=float)
+        seed = np.where(np.isnan(value(out[objective])), 0, seed)
+
+        backward(out[objective], seed)
+
+    #outputs
+    df = df_in.copy()
+    for c in MODEL_OUTPUTS:
+        df[c] = value(out[c])
+
+    gradient = pd.DataFrame({c: _grad(x[c]) for c in inputs}, index=df_in.index, columns=inputs)
+
+    gradient_mh = None
+    if multihazard_data is not None:
+        gradient_mh = pd.DataFrame({c: _grad(x_mh[c]) for c in x_mh}, index=multihazard_data.index, columns=multihazard_data.columns)
+
+    return df, gradient, gradient_mh
+
+def _grad(x):
+    """Gradient of an input, zeros if the objective does not depend on it"""
+    if x.grad is None:
+        return np.zeros(len(x.value))
+    return x.grad
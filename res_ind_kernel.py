@@ -0,0 +1,263 @@
+import numpy as np
+import pandas as pd
+
+#columns of the broadcast dataframe read by the kernel
+KERNEL_INPUTS = ["pov_head","cp","cr","fap","far","v_p","v_r","pi","shewp","shewr","v_s",
+                 "T_rebuild_K","rho","avg_prod_k","social_p","social_r","sigma_p","sigma_r",
+                 "income_elast","pop","protection"]
+
+#columns produced by the kernel (same as res_ind_lib.compute_dK_dW)
+KERNEL_OUTPUTS = ["dK","delta_W","dcap","dcar","dKtot"]
+
+#province level columns read by compute_risk_arrays
+RISK_INPUTS = ["rho","gdp_pc_pp_nat","income_elast","protection","pop","gdp_pc_pp"]
+
+#all the columns added by res_ind_lib.compute_resiliences
+MODEL_OUTPUTS = KERNEL_OUTPUTS+["dWpc_curency","dWtot_currency","risk","resilience","risk_to_assets"]
+
+
+def frame_to_arrays(df, columns=KERNEL_INPUTS, dtype=np.float64):
+    """Struct-of-arrays view of df: a dict of contiguous arrays keyed by column name.
+    Does not copy columns that are already contiguous and of the right dtype."""
+    return {c: np.ascontiguousarray(df[c].values, dtype=dtype) for c in columns}
+
+def arrays_to_frame(arrays, index, columns=KERNEL_OUTPUTS):
+    """Wraps kernel outputs back in a dataframe"""
+    return pd.DataFrame({c: arrays[c] for c in columns}, index=index, columns=columns)
+
+
+class KernelWorkspace:
+    """Scratch buffers for compute_dK_dW_arrays.
+    Keep one around and pass it to successive calls to avoid reallocating temporaries.
+    dtype: float type of the computation (np.float64, or np.float32 to halve memory traffic; see compute_dK_dW_arrays)"""
+
+    def __init__(self, n=0, dtype=np.float64):
+        self.n = n
+        self.dtype = dtype
+        self.buffers = {}
+
+    def get(self, name, n, dtype=None):
+        """Returns the buffer called name, (re)allocated if the number of rows changed
+        dtype: overrides the dtype of the workspace for this buffer"""
+        if n!=self.n:
+            self.n = n
+            self.buffers = {}
+        b = self.buffers.get(name)
+        if b is None:
+            b = self.buffers[name] = np.empty(n, dtype=self.dtype if dtype is None else dtype)
+        return b
+
+
+def compute_dK_dW_arrays(a, out=None, work=None):
+    """Computes dK, delta_W, dcap, dcar and dKtot line by line from a dict of arrays (see frame_to_arrays).
+    Same equations as res_ind_lib.compute_dK_dW, without index alignment.
+    out: optional dict of preallocated output arrays, filled in place.
+    work: optional KernelWorkspace, reused between calls. Its dtype is that of the computation (float64 by default, that of the inputs if work is not provided).
+    With float32, welfare losses are still computed in float64."""
+
+    n = len(a["cp"])
+    if work is None:
+        work = KernelWorkspace(n, a["cp"].dtype)
+    if out is None:
+        out = {c: np.empty(n, dtype=work.dtype) for c in KERNEL_OUTPUTS}
+    buf = lambda name: work.get(name, n)
+
+    ph = a["pov_head"]
+    fap = a["fap"]
+    far = a["far"]
+    cp = a["cp"]
+    cr = a["cr"]
+    rho = a["rho"]
+    mu = a["avg_prod_k"]
+
+    #early-warning-adjusted vulnerability
+    vp = _one_minus_prod(a["pi"], a["shewp"], buf("vp"))
+    np.multiply(a["v_p"], vp, out=vp)
+    vr = _one_minus_prod(a["pi"], a["shewr"], buf("vr"))
+    np.multiply(a["v_r"], vr, out=vr)
+
+    # Link between immediate and discounted losses: (mu +3/N)/(rho+3/N)
+    gamma = buf("gamma")
+    tmp = buf("tmp")
+    np.divide(3, a["T_rebuild_K"], out=tmp)
+    np.add(mu, tmp, out=gamma)
+    np.add(rho, tmp, out=tmp)
+    np.divide(gamma, tmp, out=gamma)
+
+    #Ex-post support (1-la = (1-social)*(1-sigma))
+    one_minus_la_p = _prod_of_one_minus(a["social_p"], a["sigma_p"], buf("olap"), tmp)
+    one_minus_la_r = _prod_of_one_minus(a["social_r"], a["sigma_r"], buf("olar"), tmp)
+
+    #fractions of family non-poor/poor affected/non affected over total pop
+    #(in float64 whatever the dtype of the computation: welfare before and after the disaster must weigh the same population)
+    wide = lambda name, dtype=np.float64: work.get(name, n, dtype)
+    nr = np.subtract(1, ph, out=wide("nr"), dtype=np.float64)
+    nap = np.multiply(ph, fap, out=wide("nap"), dtype=np.float64)
+    nar = np.multiply(nr, far, out=wide("nar"), dtype=np.float64)
+    nnp = np.subtract(1, fap, out=wide("nnp"), dtype=np.float64)
+    np.multiply(ph, nnp, out=nnp)
+    nnr = np.subtract(1, far, out=wide("nnr"), dtype=np.float64)
+    np.multiply(nr, nnr, out=nnr)
+
+    #capital from consumption and productivity
+    kp = np.divide(cp, mu, out=buf("kp"))
+    kr = np.divide(cr, mu, out=buf("kr"))
+
+    #total capital losses per family
+    dK = out["dK"]
+    np.multiply(kp, vp, out=dK)
+    np.multiply(dK, nap, out=dK)
+    np.multiply(kr, vr, out=tmp)
+    np.multiply(tmp, nar, out=tmp)
+    np.add(dK, tmp, out=dK)
+
+    # consumption losses per category of population
+    d_cnp = _shared_losses(fap, a["v_s"], one_minus_la_p, kp, buf("d_cnp"))
+    d_cnr = _shared_losses(far, a["v_s"], one_minus_la_r, kr, buf("d_cnr"))
+
+    d_cap = out["dcap"]
+    np.multiply(vp, one_minus_la_p, out=d_cap)
+    np.multiply(d_cap, kp, out=d_cap)
+    np.add(d_cap, d_cnp, out=d_cap)
+
+    d_car = out["dcar"]
+    np.multiply(vr, one_minus_la_r, out=d_car)
+    np.multiply(d_car, kr, out=d_car)
+    np.add(d_car, d_cnr, out=d_car)
+
+    #welfare cost, summed over categories of population (in float64 whatever the dtype of the computation)
+    cp_rho = np.divide(cp, rho, out=wide("cp_rho"), dtype=np.float64)
+    cr_rho = np.divide(cr, rho, out=wide("cr_rho"), dtype=np.float64)
+    categories = ((nap, cp_rho, d_cap), (nnp, cp_rho, d_cnp), (nar, cr_rho, d_car), (nnr, cr_rho, d_cnr))
+
+    delta_W = _delta_welfare_into(_elasticity(a["income_elast"]), categories, gamma, wide("delta_W"), wide)
+
+    #counting losses as +
+    out["delta_W"][:] = delta_W
+
+    #total asset losses
+    dKtot = out["dKtot"]
+    np.multiply(dK, a["pop"], out=dKtot)
+    np.divide(dKtot, a["protection"], out=dKtot)
+
+    return out
+
+
+def compute_risk_arrays(a, out, work=None):
+    """Computes dWpc_curency, dWtot_currency, risk, resilience and risk_to_assets from dK and delta_W, in place in out (a dict of arrays that holds dK and delta_W).
+    Same equations as res_ind_lib.calc_risk_and_resilience_from_k_w.
+    a: dict of arrays with the columns in RISK_INPUTS.
+    work: optional KernelWorkspace, reused between calls."""
+
+    n = len(out["dK"])
+    if work is None:
+        work = KernelWorkspace(n, out["dK"].dtype)
+    buf = lambda name: work.get(name, n)
+
+    #marginal welfare at national income
+    wprime = np.divide(a["gdp_pc_pp_nat"], a["rho"], out=buf("wprime"))
+    e = _elasticity(a["income_elast"])
+    if np.ndim(e)==0:
+        np.power(wprime, -e, out=wprime)
+    else:
+        np.power(wprime, np.negative(e, out=buf("minus_e")), out=wprime)
+
+    with np.errstate(divide="ignore", invalid="ignore"): #provinces without losses have no resilience, as with pandas
+        #expected welfare loss (per family and total)
+        np.divide(out["delta_W"], wprime, out=out["dWpc_curency"])
+        np.divide(out["dWpc_curency"], a["protection"], out=out["dWpc_curency"])
+        np.multiply(out["dWpc_curency"], a["pop"], out=out["dWtot_currency"])
+
+        #risk to welfare as percentage of local GDP
+        np.divide(out["dWpc_curency"], a["gdp_pc_pp"], out=out["risk"])
+
+        #socio-economic capacity
+        np.multiply(wprime, out["dK"], out=out["resilience"])
+        np.divide(out["resilience"], out["delta_W"], out=out["resilience"])
+
+    #risk to assets
+    np.multiply(out["resilience"], out["risk"], out=out["risk_to_assets"])
+
+    return out
+
+
+def _one_minus_prod(x, y, out):
+    """1-x*y"""
+    np.multiply(x, y, out=out)
+    return np.subtract(1, out, out=out)
+
+def _prod_of_one_minus(x, y, out, tmp):
+    """(1-x)*(1-y)"""
+    np.subtract(1, x, out=out)
+    np.subtract(1, y, out=tmp)
+    return np.multiply(out, tmp, out=out)
+
+def _shared_losses(fa, v_shared, one_minus_la, k, out):
+    """fa*v_shared*la*k"""
+    np.subtract(1, one_minus_la, out=out)
+    np.multiply(out, fa, out=out)
+    np.multiply(out, v_shared, out=out)
+    return np.multiply(out, k, out=out)
+
+def _elasticity(elast):
+    """The income elasticity as a scalar when all rows have the same (as usual, so powers have a scalar exponent), the array itself otherwise
+    (for example when the elasticity is sampled, see uncertainty.monte_carlo)"""
+    if len(elast)>0 and (elast==elast[0]).all():
+        return float(elast[0])
+    return elast
+
+def _delta_welfare_into(e, categories, gamma, out, buf):
+    """Sum of share*(welf(cbar,e)-welf(cbar-gamma*d,e)) over the (share, cbar, d) in categories, written into out.
+    e: the elasticity, a scalar or one per row (see _elasticity).
+    Each loss is computed from the relative loss gamma*d/cbar (see res_ind_lib.welf_loss), with one power per distinct cbar."""
+    x = buf("x")
+    y = buf("y")
+    out[:] = 0
+
+    if np.ndim(e)==0:
+        e1 = 1-e
+        log_rows = None
+        all_log = e==1
+    else:
+        e1 = np.subtract(1, e, out=buf("e1"))
+        #rows with elasticity 1 (log utility), None if there are none. Their power terms are computed with 1-e=1 (finite), then overwritten
+        log_rows = np.equal(e, 1, out=buf("log_rows", bool))
+        if log_rows.any():
+            np.copyto(e1, 1, where=log_rows)
+        else:
+            log_rows = None
+        all_log = False
+
+    #-gamma/cbar and cbar**(1-e)/(e-1), once per distinct cbar
+    factors = {}
+    for _, cbar, _ in categories:
+        if id(cbar) not in factors:
+            k = len(factors)
+            g = np.divide(gamma, cbar, out=buf("g{}".format(k)))
+            np.negative(g, out=g)
+            w = None
+            if not all_log:
+                w = np.power(cbar, e1, out=buf("w{}".format(k)))
+                np.divide(w, -e1, out=w)
+            factors[id(cbar)] = g, w
+
+    for share, cbar, d in categories:
+        g, w = factors[id(cbar)]
+
+        #log(1-gamma*d/cbar)
+        np.multiply(d, g, out=x)
+        np.log1p(x, out=x)
+
+        if all_log:
+            np.negative(x, out=y)
+        else:
+            #cbar**(1-e)*(1-(1-gamma*d/cbar)**(1-e))/(1-e)
+            np.multiply(x, e1, out=y)
+            np.expm1(y, out=y)
+            np.multiply(w, y, out=y)
+            if log_rows is not None:
+                np.negative(x, out=y, where=log_rows)
+
+        np.multiply(share, y, out=y)
+        np.add(out, y, out=out)
+    return out
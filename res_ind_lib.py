@@ -1,40 +1,89 @@
 import numpy as np
 import pandas as pd
+from scipy import sparse
 
-def compute_resiliences(df_in, fa_ratios=None, multihazard_data =None):
-    """Main function. Computes all outputs (dK, resilience, dC, etc,.) from inputs"""
+from res_ind_kernel import frame_to_arrays, arrays_to_frame, compute_dK_dW_arrays, KERNEL_INPUTS, KERNEL_OUTPUTS
+from instrumentation import stage
 
-    df=df_in.copy()
-    
-    #blends multihazard data
-    dfh = broadcast_hazard(multihazard_data, df)
-   
-    #interpolate fa rations and blends far ratios data
-    fa_ratios = interpolate_faratios(fa_ratios, df_in.protection.unique().tolist())
-    dfhr = broadcast_return_periods(fa_ratios, dfh)
-   
-    #computes dk_{hazard, return} and dW_{hazard, return}
-    dkdwhr=compute_dK_dW(dfhr)
-    
-    #dk_{hazard} and dW_{hazard}
-    dkdwh = average_over_rp(dkdwhr,dfhr["protectionref"])
-    
-    #Sums over hazard dk, dW
-    dkdw = sum_over_hazard(dkdwh)
+def compute_resiliences(df_in, fa_ratios=None, multihazard_data =None, engine="pandas", integration="bins"):
+    """Main function. Computes all outputs (dK, resilience, dC, etc,.) from inputs
+    engine: "pandas" or "numpy". The numpy engine computes dk and dW with the array kernel of res_ind_kernel, 
+    on the columns it needs only, gathered on the events with EventIndex.
+    integration: how outputs are averaged over return periods (see rp_weight_matrix)
+    Each stage is recorded when run inside instrumentation.profile_stages."""
 
-    #adds dk and dw-like columns to df
-    df[dkdw.columns]=dkdw
-    
-    #computes socio economic capacity and risk
-    df = calc_risk_and_resilience_from_k_w(df)
+    with stage("compute_resiliences", df_in) as s_all:
+        df=df_in.copy()
+        
+        if engine=="numpy":
+            #gathers only the columns used by the array kernel on the events (provinces x hazards x return periods)
+            with stage("EventIndex", df_in) as s:
+                events = EventIndex(df_in, fa_ratios, multihazard_data)
+                s.output(events.index)
+            with stage("take", df) as s:
+                arrays = s.output(events.take(df, KERNEL_INPUTS))
+            with stage("compute_dK_dW", arrays) as s:
+                dkdwhr = s.output(arrays_to_frame(compute_dK_dW_arrays(arrays), events.index))
+            protectionref = pd.Series(events.take(df, ["protectionref"])["protectionref"], index=events.index)
+        
+        else:
+            #blends multihazard data
+            with stage("broadcast_hazard", df) as s:
+                dfh = s.output(broadcast_hazard(multihazard_data, df))
+           
+            #interpolate fa rations and blends far ratios data
+            with stage("interpolate_faratios", fa_ratios) as s:
+                fa_ratios_interp = s.output(interpolate_faratios(fa_ratios, df_in.protection.unique().tolist()))
+            with stage("broadcast_return_periods", dfh) as s:
+                dfhr = s.output(broadcast_return_periods(fa_ratios_interp, dfh))
+            
+            #stacked scenarios (see policy_assessment.compute_policies) only keep the return periods they would have been computed with alone
+            if fa_ratios is not None and "scenario" in df.index.names:
+                with stage("restrict_return_periods", dfhr) as s:
+                    dfhr = s.output(restrict_return_periods(dfhr, fa_ratios, df_in.protection))
+           
+            #computes dk_{hazard, return} and dW_{hazard, return}
+            with stage("compute_dK_dW", dfhr) as s:
+                dkdwhr = s.output(compute_dK_dW(dfhr, engine=engine))
+            protectionref = dfhr["protectionref"]
+        
+        #dk_{hazard} and dW_{hazard}
+        with stage("average_over_rp", dkdwhr) as s:
+            dkdwh = s.output(average_over_rp(dkdwhr,protectionref,integration))
+        
+        #Sums over hazard dk, dW
+        with stage("sum_over_hazard", dkdwh) as s:
+            dkdw = s.output(sum_over_hazard(dkdwh))
+
+        #adds dk and dw-like columns to df
+        df[dkdw.columns]=dkdw
+        
+        #computes socio economic capacity and risk
+        with stage("calc_risk_and_resilience_from_k_w", df) as s:
+            df = s.output(calc_risk_and_resilience_from_k_w(df))
+        s_all.output(df)
 
     return df
 
     
     
-def compute_dK_dW(df):  
+def compute_dK_dW(df, engine="pandas"):  
     '''Computes dk and dW line by line. 
-    presence of multiple return period or multihazard data is transparent to this function'''    
+    presence of multiple return period or multihazard data is transparent to this function
+    engine: "pandas" (default) or "numpy" (same outputs, computed on contiguous arrays)'''    
+
+    if engine=="numpy":
+        return arrays_to_frame(compute_dK_dW_arrays(frame_to_arrays(df)), df.index)
+    elif engine!="pandas":
+        raise ValueError("unknown engine: "+str(engine))
+
+    return pd.DataFrame(dK_dW_equations(df), index=df.index, columns=KERNEL_OUTPUTS)
+
+
+def dK_dW_equations(df, loss=None):
+    '''Equations of compute_dK_dW. Returns a dict of columns.
+    df can be a dataframe or a dict of arrays (or of res_ind_derivatives.Dual, etc.). 
+    loss: welfare loss function used instead of welf_loss, if provided (for example res_ind_derivatives.welf_loss_ad)'''
 
     ###############################
     #Description of inequalities
@@ -90,11 +139,11 @@ def compute_dK_dW(df):
     ############
     #Welfare losses 
     
-    delta_W,dK,dcap,dcar =calc_delta_welfare(ph,fap,far,vp,vr,v_shared,cp,cr,tot_p,tot_r,mu,gamma,rho,elast)
+    delta_W,dK,dcap,dcar =calc_delta_welfare(ph,fap,far,vp,vr,v_shared,cp,cr,tot_p,tot_r,mu,gamma,rho,elast,loss=loss)
     
     ###########
     #OUTPUT
-    df_out = pd.DataFrame(index=df.index)
+    df_out = dict()
     
     #corrects from avoided losses through national risk sharing
     df_out["dK"] = dK
@@ -106,8 +155,9 @@ def compute_dK_dW(df):
    
     return df_out
         
-def calc_risk_and_resilience_from_k_w(df): 
-    """Computes risk and resilience from dk, dw and protection. Line by line: multiple return periods or hazard is transparent to this function"""
+def calc_risk_and_resilience_from_k_w(df, prime=None): 
+    """Computes risk and resilience from dk, dw and protection. Line by line: multiple return periods or hazard is transparent to this function
+    df can be a dataframe or a dict of columns. prime: marginal welfare function used instead of welf_prime, if provided (for example res_ind_derivatives.welf_prime_ad)"""
     
     df=df.copy()    
     
@@ -116,12 +166,11 @@ def calc_risk_and_resilience_from_k_w(df):
     
     #discount rate
     rho = df["rho"]
-    h=1e-4
     
     #Reference losses
-    h=1e-4
-    
-    wprime =(welf(df["gdp_pc_pp_nat"]/rho+h,df["income_elast"])-welf(df["gdp_pc_pp_nat"]/rho-h,df["income_elast"]))/(2*h)
+    if prime is None:
+        prime = welf_prime
+    wprime = prime(df["gdp_pc_pp_nat"]/rho,df["income_elast"])
     
     dWref   = wprime*df["dK"]
     
@@ -138,13 +187,14 @@ def calc_risk_and_resilience_from_k_w(df):
 
     ############
     #RISK TO ASSETS
-    df["risk_to_assets"]  =df.resilience* df.risk;
+    df["risk_to_assets"]  =df["resilience"]* df["risk"];
     
     return df
     
     
-def calc_delta_welfare(ph,fap,far,vp,vr,v_shared,cp,cr,la_p,la_r,mu,gamma,rho,elast):
-    """welfare cost from consumption losses"""
+def calc_delta_welfare(ph,fap,far,vp,vr,v_shared,cp,cr,la_p,la_r,mu,gamma,rho,elast,loss=None):
+    """welfare cost from consumption losses
+    loss: welfare loss function used instead of welf_loss, if provided"""
 
     #fractions of family non-poor/poor affected/non affected over total pop
     nap= ph*fap
@@ -172,14 +222,13 @@ def calc_delta_welfare(ph,fap,far,vp,vr,v_shared,cp,cr,la_p,la_r,mu,gamma,rho,el
     d_npv_cap= gamma*d_cur_cap
     d_npv_car= gamma*d_cur_car
     
-    #welfare cost 
-    Wpre =ph* welf(cp/rho,elast) + (1-ph)*welf(cr/rho,elast)
-    
-    Wpost=  nap*welf(cp/rho-d_npv_cap,elast) + \
-            nnp*welf(cp/rho-d_npv_cnp,elast) + \
-            nar*welf(cr/rho-d_npv_car,elast)+ \
-            nnr*welf(cr/rho-d_npv_cnr,elast)
-    dW =Wpre -Wpost #counting losses as +
+    #welfare cost: sum of the losses of each category (nap+nnp=ph and nar+nnr=1-ph), without the difference of two close welfare levels
+    if loss is None:
+        loss = welf_loss
+    dW =nap*loss(cp/rho,d_npv_cap,elast) + \
+        nnp*loss(cp/rho,d_npv_cnp,elast) + \
+        nar*loss(cr/rho,d_npv_car,elast) + \
+        nnr*loss(cr/rho,d_npv_cnr,elast)
 
     return dW,dK, d_cur_cap, d_cur_car
     
@@ -195,6 +244,24 @@ def welf(c,elast):
     
     return u
     
+def welf_loss(c,dc,elast):
+    """welf(c,elast)-welf(c-dc,elast), computed from the relative loss dc/c (log1p and expm1): accurate even when dc is small compared to c"""
+    
+    x = np.log1p(-dc/c)
+    e1 = 1-elast
+    
+    with np.errstate(divide="ignore", invalid="ignore"): #rows with elasticity 1 are patched below
+        dw = -c**e1*np.expm1(e1*x)/e1
+    
+    cond = elast==1
+    dw[cond] = -x[cond]
+    
+    return dw
+    
+def welf_prime(c,elast):
+    """Derivative of welf with respect to c (marginal welfare)"""
+    return c**(-elast)
+    
 def invert_welf(u,elast):
     """ Invert function of the welfare function """
     
@@ -206,10 +273,17 @@ def invert_welf(u,elast):
     return c
     
     
+#inputs of calc_v_s
+V_S_INPUTS = ["v_r","pi","shewr"]
+
+def calc_v_s(df):
+    #vulnerability of shared losses, from v_r (df: dataframe or dict of arrays)
+    return df["v_r"]* (1-df["pi"]*df["shewr"])
+
 def def_ref_values(df):
     #fills the "ref" variables (those protected when computing derivatives)
     
-    df["v_s"] = df["v_r"]* (1-df["pi"]*df["shewr"])
+    df["v_s"] = calc_v_s(df)
     df["protectionref"] = df["protection"]
     
     return df
@@ -219,19 +293,15 @@ def broadcast_hazard(hazard_info, df_in):
     if hazard_info is None:
         return df_in
     
-    hazard_info=hazard_info.reset_index()
+    #line of df_in and of hazard_info of each (province, hazard)
+    rows, mh_rows, index = hazard_gather(hazard_info.index, df_in.index)
     
-    hazard_list = hazard_info.hazard.unique()
-    
-    nb_hazards =len(hazard_list)
-    df = pd.concat(
-        [df_in]*nb_hazards,
-        axis=1, keys=hazard_list, names=["hazard","var"]
-        ).stack("hazard").sort_index().sortlevel()#.reset_index("hazard")
+    df = df_in.take(rows)
+    df.index = index
     
     # copies multi hazard info in the casted dataframe
-    mh = hazard_info.set_index(["province","hazard"])
-    df[mh.columns]=mh
+    for c in hazard_info.columns:
+        df[c]=hazard_info[c].values[mh_rows]
     
     return df.dropna()
     
@@ -242,20 +312,183 @@ def broadcast_return_periods(fa_ratios, df_in):
     if fa_ratios is None:
         return df_in
     
-    nrps =len(fa_ratios.columns)
-    df = pd.concat(
-        [df_in.copy(deep=True)]*nrps,
-        axis=1, keys=fa_ratios.columns, names=["rp","var"]
-        ).swaplevel("var","rp",axis=1).sortlevel(0,axis=1).stack("rp")#Reshapes into ((province,rp), vars) 
+    #line of df_in and fa ratio of each (province, hazard, rp)
+    rows, ratios, index = rp_gather(fa_ratios, df_in.index)
+    
+    df = df_in.take(rows)
+    df.index = index
     
     #introduces different exposures for different return periods
-    df["fap"]=df["fap"]*fa_ratios.stack("rp")
-    df["far"]=df["far"]*fa_ratios.stack("rp")
+    df["fap"]=df["fap"].values*ratios
+    df["far"]=df["far"].values*ratios
     
+    return df.dropna()
     
-    # df=df#.reset_index("rp")#.set_index(["province","rp"])
+
+def hazard_gather(hazard_index, index):
+    """Gather index of the broadcast over hazards, without sorting or copying data.
+    hazard_index: index of the multi hazard data (province, hazard, and possibly other levels of index).
+    Returns (rows, mh_rows, index_out): for each (line of index, hazard) pair found in hazard_index, the line of index, the line of hazard_index, and the broadcast index (index levels, hazard)"""
     
-    return df.dropna()
+    hazards = np.asarray(hazard_index.get_level_values("hazard").unique())
+    
+    n = len(index)
+    rows = np.repeat(np.arange(n), len(hazards))
+    
+    index_out = pd.MultiIndex.from_arrays(
+        [index.get_level_values(i)[rows] for i in range(index.nlevels)]+[np.tile(hazards, n)], 
+        names=list(index.names)+["hazard"])
+    
+    mh_rows = hazard_index.get_indexer(level_keys(index_out, hazard_index.names))
+    
+    found = mh_rows>=0
+    return rows[found], mh_rows[found], index_out[found]
+    
+def rp_gather(fa_ratios, index):
+    """Gather index of the broadcast over return periods (the columns of fa_ratios), without sorting or copying data.
+    Returns (rows, ratios, index_out): for each (line of index, return period), the line of index, the fa ratio (nan if index is not in fa_ratios), and the broadcast index (index levels, rp)"""
+    
+    rps = fa_ratios.columns.values
+    
+    n = len(index)
+    rows = np.repeat(np.arange(n), len(rps))
+    cols = np.tile(np.arange(len(rps)), n)
+    
+    index_out = pd.MultiIndex.from_arrays(
+        [index.get_level_values(i)[rows] for i in range(index.nlevels)]+[rps[cols]], 
+        names=list(index.names)+["rp"])
+    
+    fa_rows = fa_ratios.index.get_indexer(level_keys(index, fa_ratios.index.names))[rows]
+    ratios = np.where(fa_rows>=0, fa_ratios.values[fa_rows, cols], np.nan)
+    
+    return rows, ratios, index_out
+    
+
+class EventIndex:
+    """Gather index of the events (lines of the data broadcast over hazards and return periods, as in compute_resiliences), without copying any data.
+    Columns are only gathered on events when asked for (see take).
+    index: index of the events
+    province: line of df_in of each event
+    hazard_row: line of multihazard_data of each event (None without multi hazard data)
+    ratio: fa ratio of each event (None without fa ratios)"""
+    
+    def __init__(self, df_in, fa_ratios=None, multihazard_data=None):
+        
+        self.multihazard_data = multihazard_data
+        self.mh_columns = [] if multihazard_data is None else multihazard_data.columns.tolist()
+        
+        index = df_in.index
+        self.province = np.arange(len(index))
+        self.hazard_row = None
+        self.ratio = None
+        
+        if multihazard_data is not None:
+            rows, self.hazard_row, index = hazard_gather(multihazard_data.index, index)
+            self.province = self.province[rows]
+        
+        if fa_ratios is not None:
+            fa_ratios_interp = interpolate_faratios(fa_ratios, df_in.protection.unique().tolist())
+            rows, self.ratio, index = rp_gather(fa_ratios_interp, index)
+            self.province = self.province[rows]
+            if self.hazard_row is not None:
+                self.hazard_row = self.hazard_row[rows]
+        
+        self.index = index
+        
+        #drops events with missing data, as the dropna of broadcast_hazard and broadcast_return_periods
+        valid = ~df_in.drop(self.mh_columns, axis=1).isnull().any(axis=1).values[self.province]
+        if multihazard_data is not None:
+            valid &= ~multihazard_data.isnull().any(axis=1).values[self.hazard_row]
+        if self.ratio is not None:
+            valid &= ~np.isnan(self.ratio)
+        
+        #stacked scenarios only keep the return periods they would have been computed with alone
+        if fa_ratios is not None and "scenario" in df_in.index.names:
+            valid &= own_return_periods(index, fa_ratios, df_in.protection)
+        
+        if not valid.all():
+            self.keep(valid)
+    
+    def keep(self, mask):
+        """Keeps only the events in mask"""
+        self.index = self.index[mask]
+        self.province = self.province[mask]
+        if self.hazard_row is not None:
+            self.hazard_row = self.hazard_row[mask]
+        if self.ratio is not None:
+            self.ratio = self.ratio[mask]
+    
+    def take(self, df_in, columns, multihazard_data=None, out=None):
+        """Gathers columns on events (from multihazard_data for the columns it contains). Returns a dict of arrays.
+        multihazard_data: replaces the multi hazard data the index was built with (it must have the same lines)
+        out: optional dict of float arrays (one value per event), filled in place for the columns it contains"""
+        if multihazard_data is None:
+            multihazard_data = self.multihazard_data
+        if out is None:
+            out = dict()
+        for c in columns:
+            if c in self.mh_columns:
+                values, rows = multihazard_data[c].values, self.hazard_row
+            else:
+                values, rows = df_in[c].values, self.province
+            if c in out:
+                #rows are all valid: mode="clip" avoids the temporary copy of mode="raise"
+                np.take(values.astype(out[c].dtype, copy=False), rows, out=out[c], mode="clip")
+            else:
+                out[c] = values[rows].astype(float)
+            if c in ["fap","far"] and self.ratio is not None:
+                out[c] *= self.ratio
+        return out
+
+    
+class EventPlan:
+    """How the events (lines of the data broadcast over hazards and return periods) read their inputs and are aggregated back to provinces.
+    Holds the EventIndex, and the average over return periods and sum over hazards as a sparse (provinces x events) matrix.
+    integration: how events are averaged over return periods (see rp_weight_matrix)"""
+
+    def __init__(self, df_in, fa_ratios=None, multihazard_data=None, integration="bins"):
+
+        events = EventIndex(df_in, fa_ratios, multihazard_data)
+        self.events = events
+
+        self.index = df_in.index
+
+        #line of df_in of each event, line of multihazard_data of each event, and columns of df_in superseded by multihazard_data
+        self.province = events.province
+        self.hazard_row = events.hazard_row
+        self.mh_columns = events.mh_columns
+
+        #fa ratio of each event (multiplies fap and far)
+        self.ratio = events.ratio
+
+        #average over return periods and sum over hazards
+        weights = rp_weights(events.index, events.take(df_in, ["protectionref"])["protectionref"], integration)
+        self.aggregation = sparse.csr_matrix((weights, (self.province, np.arange(len(events.index)))), shape=(len(self.index), len(events.index)))
+
+        #provinces without any event get no result
+        self.no_events = np.bincount(self.province, minlength=len(self.index))==0
+
+    def aggregate(self, x, out=None):
+        """Averages x (one value per event) over return periods and sums it over hazards, as average_over_rp and sum_over_hazard do
+        out: optional array (one value per line of df_in) filled in place"""
+        if out is None:
+            out = self.aggregation.dot(x)
+        else:
+            out[:] = self.aggregation.dot(x)
+        out[self.no_events] = np.nan
+        return out
+
+
+def align_on_levels(data, index):
+    """Reindexes data on index, matching only the levels named in data's index.
+    This lets data indexed by (province, hazard) be spread over a dataframe indexed by (scenario, province, hazard, rp)"""
+    return data.reindex(level_keys(index, data.index.names))
+    
+def level_keys(index, names):
+    """The levels of index called names, as an index (a MultiIndex if there are several names)"""
+    if len(names)==1:
+        return index.get_level_values(names[0])
+    return pd.MultiIndex.from_arrays([index.get_level_values(n) for n in names])
     
 
 from scipy.interpolate import interp1d
@@ -279,13 +512,35 @@ def interpolate_faratios(fa_ratios,protection_list):
     y = fa_ratios_rps.values
     fa_ratios_rps= pd.concat(
         [pd.DataFrame(interp1d(x,y,bounds_error=False)(all_rps),index=fa_ratios_rps.index, columns=all_rps)]
-        ,axis=1).sort_index(axis=1).clip(lower=0).fillna(method="pad",axis=1)
+        ,axis=1).sort_index(axis=1).clip(lower=0).ffill(axis=1)
     fa_ratios_rps.columns.name="rp"
 
     return fa_ratios_rps
         
-def average_over_rp(df,protection):        
-    ###AGGREGATION OF THE OUTPUTS OVER RETURN PERIODS
+def restrict_return_periods(df, fa_ratios, protection, level="scenario"):
+    """Keeps the rows of df whose return period is either in fa_ratios, 0, or one of the protection levels of the same scenario (level).
+    Used when several scenarios are stacked: interpolate_faratios then adds the protection levels of all scenarios to the return periods."""
+    return df[own_return_periods(df.index, fa_ratios, protection, level)]
+    
+def own_return_periods(index, fa_ratios, protection, level="scenario"):
+    """Boolean mask of the lines of index kept by restrict_return_periods"""
+    
+    scenarios = protection.index.get_level_values(level)
+    
+    #return periods of each scenario
+    own_rps = pd.MultiIndex.from_arrays([scenarios, protection.values]).append(
+        pd.MultiIndex.from_product([scenarios.unique(), [0]+fa_ratios.columns.tolist()]))
+    
+    rows = pd.MultiIndex.from_arrays([index.get_level_values(level), index.get_level_values("rp")])
+    
+    return rows.isin(own_rps)
+
+        
+def average_over_rp(df,protection,integration="bins"):        
+    """Aggregation of the outputs over return periods. 
+    Events are laid out as a dense (entities x return periods) array, and averaged with the weights of rp_weight_matrix.
+    protection: protection level (protectionref) of each line of df
+    integration: "bins", "trapezoidal" or "loglinear" (see rp_weight_matrix)"""
     
     #does nothing if df does not contain data on return periods
     try:
@@ -294,29 +549,125 @@ def average_over_rp(df,protection):
     except(TypeError):
         pass
     
-    df=df.copy().reset_index("rp")
-    protection=protection.copy().reset_index("rp",drop=True)
+    entity, rp_col, entities, weights = rp_weight_matrix(df.index, np.asarray(protection, dtype=float), integration)
     
-    #computes probability of each return period
-    return_periods=np.unique(df["rp"].dropna())
+    #average weighted by proba (missing values count as 0, as in a pandas sum)
+    averaged = pd.DataFrame(index=entities, columns=df.columns, dtype=float)
+    values = np.zeros(weights.shape)
+    for c in df.columns:
+        values[entity, rp_col] = df[c].values
+        averaged[c] = np.einsum("er,er->e", weights, np.where(np.isnan(values), 0, values))
+    
+    return averaged
 
-    proba = pd.Series(np.diff(np.append(1/return_periods,0)[::-1])[::-1],index=return_periods) #removes 0 from the rps
 
-    #matches return periods and their probability
-    proba_serie=df["rp"].replace(proba)
+def rp_weight_matrix(index, protection, integration="bins"):
+    """Weights of the average over return periods, as a dense (entities x return periods) matrix.
+    Entities are the lines of index without the rp level (for example (province, hazard)). 
+    integration: 
+        "bins" (default): each return period is a discrete event. Its probability is 1/rp - 1/(next return period of the same entity), and 1/rp for the largest one. 
+            Events below the protection level of their entity get no weight. 
+        "trapezoidal" or "loglinear": outputs are a continuous curve of the frequency 1/rp, linear between return periods in 1/rp or in log(1/rp), 
+            and constant beyond the largest return period. The curve is integrated from frequency 0 to 1/protection (or to the most frequent event). 
+            Converges faster than "bins" when return periods are added, so fewer return periods are needed in fa_ratios.
+    Weights sum to one for each entity.
+    Returns (entity, rp_col, entities, weights): the line and column of each line of index in the matrix, the index of the lines of the matrix, and the matrix"""
+    
+    rp = index.get_level_values("rp").values.astype(float)
+    
+    lines = index.droplevel("rp")
+    if isinstance(lines, pd.MultiIndex):
+        #works on the level codes rather than on tuples of labels
+        key = np.ravel_multi_index([np.asarray(c)+1 for c in lines.codes], [len(l)+1 for l in lines.levels])
+        _, first, entity = np.unique(key, return_index=True, return_inverse=True)
+        entities = lines[first]
+    else:
+        entity, entities = lines.factorize(sort=True)
+        entities = entities.set_names(lines.names)
+    rp_col, rps = pd.factorize(rp, sort=True)
+    
+    E, R = len(entities), len(rps)
+    present = np.zeros((E,R), dtype=bool)
+    present[entity, rp_col] = True
+    
+    #next return period of the same entity (R if there is none)
+    col = np.where(present, np.arange(R), R)
+    next_col = np.minimum.accumulate(col[:,::-1], axis=1)[:,::-1]
+    next_col = np.append(next_col[:,1:], np.full((E,1), R), axis=1)
+    
+    with np.errstate(divide="ignore"): #the 0 return period has infinite frequency
+        freq = np.append(1/rps, 0)
+    
+    entity_protection = np.empty(E)
+    entity_protection[entity] = protection
+    
+    if integration=="bins":
+        proba = np.where(present, freq[:R]-freq[next_col], 0)
+        
+        #removes events below the protection level
+        proba[entity_protection[:,None]>rps[None,:]] = 0
+    
+    elif integration in ["trapezoidal", "loglinear"]:
+        with np.errstate(divide="ignore"):
+            proba = curve_integration_weights(present, freq, next_col, 1/entity_protection, integration)
+    
+    else:
+        raise ValueError("unknown integration: "+str(integration))
+    
+    with np.errstate(invalid="ignore"): #infinite probability of the 0 return period when protection is 0
+        weights = proba/proba.sum(axis=1, keepdims=True)
+    
+    return entity, rp_col, entities, weights
 
-    #removes events below the protection level
-    proba_serie[protection>df.rp] =0
 
-    #handles cases with multi index and single index (works around pandas limitation)
-    idxlevels = list(range(df.index.nlevels))
-    if idxlevels==[0]:
-        idxlevels =0
-        
-    #average weighted by proba
-    averaged = df.mul(proba_serie,axis=0).sum(level=idxlevels).div(proba_serie.sum(level=idxlevels),axis=0)
+def curve_integration_weights(present, freq, next_col, max_freq, integration):
+    """Integral of a piecewise curve of the frequency from 0 to max_freq, as weights on its points (not normalized).
+    Each event is the frequent end of the segment that goes to the next return period of the same entity (next_col), 
+    and the last one also carries the constant tail down to frequency 0.
+    present, next_col: as in rp_weight_matrix. freq: frequency of each return period, followed by 0.
+    max_freq: upper bound of the integral for each entity (1/protection)"""
+    
+    E, R = present.shape
+    e, r = np.nonzero(present)
+    n = next_col[e, r]
+    
+    f_b = freq[r]
+    f_a = freq[n]
+    
+    #part of the segment [f_a, f_b] below the upper bound, and the weight of its frequent end (the rest goes to its rare end)
+    f_cut = np.minimum(f_b, max_freq[e])
+    width = np.clip(f_cut-f_a, 0, None)
+    
+    with np.errstate(divide="ignore", invalid="ignore"): #segments that touch the 0 return period or are cut off
+        if integration=="trapezoidal":
+            upper = width**2/(2*(f_b-f_a))
+        else:
+            upper = (f_cut*np.log(f_cut/f_a)-width)/np.log(f_b/f_a)
+    upper[width==0] = 0
+    upper[np.isinf(f_b) & np.isfinite(f_cut)] = 0
+    
+    #constant tail beyond the largest return period
+    tail = n==R
+    upper[tail] = width[tail]
+    
+    proba = np.zeros((E, R+1))
+    np.add.at(proba, (e, r), upper)
+    np.add.at(proba, (e, n), width-upper)
+    
+    return proba[:, :R]
+
+
+def rp_weights(index, protection, integration="bins"):
+    """Weight of each event (line of index) in the average over return periods made by average_over_rp. 
+    Weights sum to one over the return periods of each (province, hazard). All weights are 1 if index has no rp level.
+    protection: array of protection levels (protectionref), one per line of index"""
+    
+    if "rp" not in index.names:
+        return np.ones(len(index))
     
-    return averaged.drop("rp",axis=1)
+    entity, rp_col, entities, weights = rp_weight_matrix(index, np.asarray(protection, dtype=float), integration)
+    
+    return weights[entity, rp_col]
 
 
 def sum_over_hazard(df):  
@@ -327,12 +678,10 @@ def sum_over_hazard(df):
     except(TypeError):
         pass
     
-    df=df.reset_index("hazard")
-    
-    #handles cases with multi index and single index (works around pandas limitation)
-    idxlevels = list(range(df.index.nlevels))
-    if idxlevels==[0]:
-        idxlevels =0
+    #sums over the other levels of the index (a single level is passed as such, so the result keeps a flat index)
+    idxlevels = [i for i, name in enumerate(df.index.names) if name!="hazard"]
+    if len(idxlevels)==1:
+        idxlevels = idxlevels[0]
     
-    return df.sum(level=idxlevels)
+    return df.groupby(level=idxlevels).sum()
         
\ No newline at end of file
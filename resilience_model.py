@@ -0,0 +1,154 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from res_ind_lib import *
+from instrumentation import stage
+from res_ind_kernel import KernelWorkspace, KERNEL_INPUTS, KERNEL_OUTPUTS, RISK_INPUTS, MODEL_OUTPUTS, compute_risk_arrays, frame_to_arrays
+
+class ResilienceModel:
+    """compute_resiliences with a cached broadcast plan.
+
+    The plan (interpolated fa ratios, gather indexes of the events, return period weights and protection masks, see EventPlan) only depends on
+    the provinces, the protection levels, the multi hazard table and the fa ratios. It is built once and reused as long as these do not change,
+    so that evaluate only reruns the arithmetic (for example when compute_policies increments cp).
+
+    fa_ratios, multihazard_data, integration: as in compute_resiliences.
+    dtype: float type of the computation on events: np.float64, or np.float32 for large batches (see compute_dK_dW_arrays and benchmarks.precision_report).
+        Outputs are aggregated and computed in float64.
+    max_plans: number of plans kept in cache (least recently used plans are dropped first).
+
+    model = ResilienceModel(fa_ratios, multihazard_data)
+    df_with_results = model.evaluate(df)
+
+    Inputs gathered on the events, event results and outputs are written in buffers of the model, allocated once per number of events (or lines of df):
+    evaluate_arrays returns these buffers without any copy.
+    """
+
+    def __init__(self, fa_ratios=None, multihazard_data=None, max_plans=8, integration="bins", dtype=np.float64):
+        self.fa_ratios = fa_ratios
+        self.integration = integration
+        self.multihazard_data = multihazard_data
+        self.max_plans = max_plans
+
+        self.plans = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        #scratch buffers of the array kernel, and buffers of inputs and outputs, reused between evaluations
+        self.dtype = dtype
+        self.workspace = KernelWorkspace(dtype=dtype)
+        self.buffers = dict()
+
+    def evaluate(self, df_in, multihazard_data=None, inplace=False):
+        """Computes all outputs (dK, resilience, dC, etc,.) from inputs, as compute_resiliences does.
+        multihazard_data: replaces the multi hazard data of the model for this evaluation
+        inplace: if True, adds the outputs to df_in instead of a copy of it"""
+
+        out = self.evaluate_arrays(df_in, multihazard_data)
+
+        df = df_in if inplace else df_in.copy()
+        for c in MODEL_OUTPUTS:
+            df[c] = out[c].copy()
+        return df
+
+    def evaluate_arrays(self, df_in, multihazard_data=None):
+        """Outputs as a dict of arrays (one value per line of df_in).
+        These arrays are buffers of the model: they are overwritten by the next evaluation."""
+
+        if multihazard_data is None:
+            multihazard_data = self.multihazard_data
+
+        with stage("plan", df_in) as s:
+            plan = self.plan(df_in, multihazard_data)
+            n = s.output(plan.events.index).size
+
+        #dk_{hazard, return} and dW_{hazard, return}
+        with stage("take", df_in) as s:
+            inputs = s.output(plan.events.take(df_in, KERNEL_INPUTS, multihazard_data, out=self.buffer("inputs", KERNEL_INPUTS, n, self.dtype)))
+        with stage("compute_dK_dW", inputs) as s:
+            dkdwhr = s.output(compute_dK_dW_arrays(inputs, out=self.buffer("events", KERNEL_OUTPUTS, n, self.dtype), work=self.workspace))
+
+        #average over return periods and sum over hazards
+        with stage("aggregate", dkdwhr) as s:
+            out = s.output(self.buffer("outputs", MODEL_OUTPUTS, len(df_in)))
+            for c in KERNEL_OUTPUTS:
+                plan.aggregate(dkdwhr[c], out=out[c])
+
+        #computes socio economic capacity and risk
+        with stage("compute_risk_arrays", out) as s:
+            return s.output(compute_risk_arrays(frame_to_arrays(df_in, RISK_INPUTS), out))
+
+    def buffer(self, name, columns, n, dtype=np.float64):
+        """Dict of arrays of length n called name, reallocated only if n changed"""
+        b = self.buffers.get(name)
+        if b is None or len(b[columns[0]])!=n:
+            b = self.buffers[name] = {c: np.empty(n, dtype=dtype) for c in columns}
+        return b
+
+    def plan(self, df_in, multihazard_data=None):
+        """The EventPlan for these inputs, from cache if their structure has already been seen"""
+
+        key = self.plan_key(df_in, multihazard_data)
+
+        if key in self.plans:
+            self.hits += 1
+            self.plans.move_to_end(key)
+            return self.plans[key]
+
+        self.misses += 1
+        plan = EventPlan(df_in, self.fa_ratios, multihazard_data, self.integration)
+        self.plans[key] = plan
+
+        #least recently used plans go first
+        while len(self.plans)>self.max_plans:
+            self.plans.popitem(last=False)
+
+        return plan
+
+    def plan_key(self, df_in, multihazard_data=None):
+        """Fingerprint of everything the plan depends on:
+        provinces, protection levels, missing data (events with missing data are dropped), multi hazard table and fa ratios"""
+
+        mh_columns = [] if multihazard_data is None else multihazard_data.columns.tolist()
+
+        parts = [_hash_index(df_in.index),
+            df_in["protection"].values, df_in["protectionref"].values,
+            _missing_rows(df_in, mh_columns)]
+
+        if multihazard_data is not None:
+            parts += [_hash_index(multihazard_data.index), np.array(mh_columns, dtype=str), multihazard_data.isnull().any(axis=1).values]
+
+        if self.fa_ratios is not None:
+            parts += [_hash_index(self.fa_ratios.index), self.fa_ratios.columns.values, self.fa_ratios.values]
+
+        return _fingerprint(*parts)
+
+    def clear(self):
+        """Drops all cached plans and buffers"""
+        self.plans.clear()
+        self.buffers.clear()
+
+
+def _missing_rows(df, exclude=[]):
+    """Lines of df with missing data in the columns not in exclude (column by column, without copying df)"""
+    missing = np.zeros(len(df), dtype=bool)
+    for c in df.columns:
+        if c not in exclude:
+            missing |= pd.isnull(df[c].values)
+    return missing
+
+def _hash_index(index):
+    """One hash per line of index"""
+    return pd.util.hash_pandas_object(index, index=False).values
+
+def _fingerprint(*arrays):
+    """Digest of the content of arrays"""
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(str((a.dtype, a.shape)).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
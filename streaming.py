@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from res_ind_lib import compute_resiliences, interpolate_faratios
+
+def stream_resiliences(chunks, output_path=None, fa_ratios=None, multihazard_data=None, prepare=None, protection_levels=None,
+                       columns=None, sum_levels=["province"], sums=["dWtot_currency","dKtot"], **kwargs):
+    """compute_resiliences on a stream of input chunks (dataframes of units, for example from read_chunks), for inputs too large to be held in memory at once.
+    Each chunk is broadcast, computed and aggregated on its own, and its results are appended to output_path (csv) before the next chunk is read,
+    so memory is bounded by the size of a chunk. Units (lines of the chunks) must not be repeated across chunks.
+    prepare: function applied to each chunk before computing (for example def_ref_values).
+    protection_levels: protection levels of all units. With fa_ratios, the return periods then include all of them, as if all units were computed at once.
+        Otherwise, each chunk only includes its own protection levels (see interpolate_faratios).
+    columns: columns written to output_path (all by default).
+    sum_levels, sums: the sums of the columns sums, per value of each of the index levels in sum_levels, are accumulated across chunks.
+    kwargs: passed to compute_resiliences (engine, integration).
+    Returns a dict with one dataframe of sums per level in sum_levels, and the "national" sums (a series)."""
+
+    if fa_ratios is not None and protection_levels is not None:
+        fa_ratios = interpolate_faratios(fa_ratios, list(np.unique(protection_levels)))
+
+    totals = {level: None for level in sum_levels}
+    totals["national"] = pd.Series(0., index=sums)
+
+    if output_path is not None and os.path.exists(output_path):
+        os.remove(output_path)
+
+    for chunk in chunks:
+        if prepare is not None:
+            chunk = prepare(chunk)
+
+        out = compute_resiliences(chunk, fa_ratios, multihazard_data, **kwargs)
+
+        if output_path is not None:
+            out.to_csv(output_path, mode="a", columns=columns, header=not os.path.exists(output_path))
+
+        #hierarchical sums
+        for level in sum_levels:
+            s = out[sums].groupby(level=level).sum()
+            totals[level] = s if totals[level] is None else totals[level].add(s, fill_value=0)
+        totals["national"] += out[sums].sum()
+
+    return totals
+
+
+def read_chunks(path, chunksize=10000, index_col=None, **kwargs):
+    """Reads path (csv, or parquet if pyarrow is installed) by chunks of chunksize lines. Yields dataframes.
+    index_col: column(s) used as index.
+    kwargs: passed to pd.read_csv"""
+
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq  #optional dependency, only for parquet files
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            chunk = batch.to_pandas()
+            if index_col is not None:
+                chunk = chunk.set_index(index_col)
+            yield chunk
+    else:
+        for chunk in pd.read_csv(path, chunksize=chunksize, index_col=index_col, **kwargs):
+            yield chunk
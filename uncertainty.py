@@ -0,0 +1,175 @@
+import numpy as np
+import pandas as pd
+
+from res_ind_kernel import KERNEL_INPUTS, KERNEL_OUTPUTS
+from res_ind_lib import EventIndex, V_S_INPUTS, calc_v_s
+from resilience_model import ResilienceModel
+
+#approximate number of values held by the array kernel per event (inputs, outputs and scratch buffers)
+values_per_event = 2*len(KERNEL_INPUTS)+len(KERNEL_OUTPUTS)
+
+def monte_carlo(df_in, distributions, n_samples, outputs=["resilience","risk"], quantiles=[0.05,0.5,0.95], bounds=None,
+                fa_ratios=None, multihazard_data=None, integration="bins", memory_budget=2**28, sketch_size=1001, seed=None, dtype=np.float64):
+    """Quantiles of outputs in each province when the inputs in distributions are uncertain.
+    Draws n_samples sets of inputs (see draw_deviations) and evaluates them as stacked batches (see stack_samples), in chunks that fit memory_budget (in bytes).
+    The quantiles are estimated on the fly with a QuantileSketch, so samples are not kept.
+    distributions: dataframe indexed by input (a column of df_in, not of multihazard_data), with columns distribution and spread (see inputs/uncertainty_description.csv).
+    bounds: dataframe with columns inf and sup, indexed by input (see inputs/inputs_info.csv). Sampled inputs are clipped to their bounds.
+    fa_ratios, multihazard_data, integration: as in compute_resiliences.
+    dtype: float type of the computation on events (np.float32 fits twice as many samples per chunk, see ResilienceModel).
+    Returns a dataframe indexed as df_in, with columns (outputs, quantile)"""
+
+    missing = distributions.index.difference(df_in.columns)
+    if len(missing)>0:
+        raise ValueError("cannot sample inputs that are not columns of df_in: "+", ".join(missing))
+
+    #(broadcast_hazard would overwrite them with multihazard_data)
+    if multihazard_data is not None:
+        hazard = distributions.index.intersection(multihazard_data.columns)
+        if len(hazard)>0:
+            raise ValueError("cannot sample inputs that multihazard_data replaces: "+", ".join(hazard))
+
+    deviations = draw_deviations(distributions, n_samples, np.random.RandomState(seed))
+
+    #chunks have the same size so the model reuses its broadcast plan
+    model = ResilienceModel(fa_ratios, multihazard_data, integration=integration, dtype=dtype)
+    chunk = samples_per_chunk(df_in, fa_ratios, multihazard_data, memory_budget, dtype)
+
+    sketch = QuantileSketch(sketch_size)
+    for start in range(0, n_samples, chunk):
+        dev = deviations.iloc[start:start+chunk]
+        stacked = stack_samples(df_in, dev, bounds)
+        out = model.evaluate_arrays(stacked)
+
+        #one line per sample, one column per (province, output)
+        values = np.stack([out[o] if o in out else stacked[o].to_numpy(dtype=float) for o in outputs], axis=-1)
+        sketch.update(values.reshape(len(dev), -1))
+
+    q = sketch.quantile(quantiles).reshape(len(quantiles), len(df_in), len(outputs))
+
+    return pd.DataFrame(q.transpose(1,2,0).reshape(len(df_in), -1), index=df_in.index,
+                        columns=pd.MultiIndex.from_product([outputs, quantiles], names=["outputs", "quantile"]))
+
+
+def draw_deviations(distributions, n_samples, rng=np.random):
+    """Relative deviation of each input from its value, in n_samples draws. The same deviation applies to all provinces in a draw.
+    distributions: dataframe indexed by input, with columns distribution and spread. distribution is
+        "uniform" (between -spread and spread), "triangular" (between -spread and spread, mode 0), or "normal" (standard deviation spread).
+    rng: a numpy RandomState"""
+
+    deviations = pd.DataFrame(index=range(n_samples), columns=distributions.index, dtype=float)
+    deviations.columns.name = "inputs"
+
+    for var in distributions.index:
+        law = distributions.loc[var, "distribution"]
+        spread = distributions.loc[var, "spread"]
+
+        if law=="uniform":
+            deviations[var] = rng.uniform(-spread, spread, n_samples)
+        elif law=="triangular":
+            deviations[var] = rng.triangular(-spread, 0, spread, n_samples)
+        elif law=="normal":
+            deviations[var] = rng.normal(0, spread, n_samples)
+        else:
+            raise ValueError("unknown distribution for "+var+": "+str(law))
+
+    return deviations
+
+
+def stack_samples(df, deviations, bounds=None):
+    """Stacks one copy of df per line of deviations along a new "scenario" index level (numbered from 0),
+    with each input in deviations.columns multiplied by (1+deviation) and clipped to bounds (if provided). v_s is recomputed if its inputs are sampled (see calc_v_s).
+    Columns are tiled as arrays and assembled once (no concatenation of frames)."""
+
+    n = len(deviations)
+    index = pd.MultiIndex.from_product([range(n), df.index], names=["scenario"]+list(df.index.names))
+
+    columns = dict()
+    for var in df.columns:
+        if var not in deviations.columns:
+            columns[var] = np.tile(df[var].to_numpy(), n)
+            continue
+
+        values = np.tile(df[var].to_numpy(dtype=float), n)
+        values *= np.repeat(1+deviations[var].values, len(df))
+
+        if bounds is not None and var in bounds.index:
+            np.clip(values,
+                np.nan_to_num(bounds.loc[var, "inf"], nan=-np.inf),
+                np.nan_to_num(bounds.loc[var, "sup"], nan=np.inf), out=values)
+
+        columns[var] = values
+
+    #v_s follows the sampled v_r, pi or shewr (see def_ref_values), unless sampled itself
+    if "v_s" in columns and "v_s" not in deviations.columns and deviations.columns.isin(V_S_INPUTS).any():
+        columns["v_s"] = calc_v_s(columns)
+
+    return pd.DataFrame(columns, index=index, columns=df.columns, copy=False)
+
+
+def samples_per_chunk(df_in, fa_ratios=None, multihazard_data=None, memory_budget=2**28, dtype=np.float64):
+    """Number of samples of df_in evaluated at once so that the events (provinces x hazards x return periods) fit memory_budget (in bytes)"""
+    events = len(EventIndex(df_in, fa_ratios, multihazard_data).index)
+    return max(1, int(memory_budget//(max(events,1)*values_per_event*np.dtype(dtype).itemsize)))
+
+
+class QuantileSketch:
+    """Approximate quantiles of a stream of samples, for many cells at once (for example provinces x outputs).
+    Keeps at most size weighted points per cell: each update merges the new samples, then compresses back to size evenly spaced quantiles.
+    The error is of order 1/size in rank. Missing values are ignored.
+
+    sketch = QuantileSketch()
+    for chunk in chunks:
+        sketch.update(chunk)  #(samples, cells) array
+    sketch.quantile([0.05, 0.5, 0.95])"""
+
+    def __init__(self, size=1001):
+        self.size = size
+        self.values = None
+        self.weights = None
+        self.count = 0
+
+    def update(self, samples):
+        """Adds samples, a (samples, cells) array"""
+        samples = np.asarray(samples, dtype=float)
+        weights = np.where(np.isnan(samples), 0., 1.)
+        self.count += len(samples)
+
+        if self.values is not None:
+            samples = np.concatenate([self.values, samples])
+            weights = np.concatenate([self.weights, weights])
+
+        if len(samples)>self.size:
+            total = weights.sum(axis=0)
+            samples = weighted_quantiles(samples, weights, (np.arange(self.size)+0.5)/self.size)
+            weights = np.tile(total/self.size, (self.size, 1))
+            weights[np.isnan(samples)] = 0
+
+        self.values = samples
+        self.weights = weights
+
+    def quantile(self, q):
+        """Quantiles q of each cell, as a (len(q), cells) array"""
+        return weighted_quantiles(self.values, self.weights, q)
+
+
+def weighted_quantiles(values, weights, q):
+    """Quantiles q of each column of values, with weights (same shape as values). Returns a (len(q), columns) array"""
+
+    q = np.asarray(q, dtype=float)
+    out = np.full((len(q), values.shape[1]), np.nan)
+
+    for j in range(values.shape[1]):
+        keep = weights[:,j]>0
+        if not keep.any():
+            continue
+
+        order = np.argsort(values[keep,j])
+        v = values[keep,j][order]
+        w = weights[keep,j][order]
+
+        #each point sits at the middle of its weight
+        mid = np.cumsum(w)-w/2
+        out[:,j] = np.interp(q*w.sum(), mid, v)
+
+    return out